@@ -0,0 +1,74 @@
+"""
+Benchmark of existence check of InstagramManager.bulk_create_from_instances on pages of different sizes.
+Compares membership check in lazy values_list QuerySet (previous implementation) with set of ids queried
+by chunks. Half of ids of each page exist in SQLite database in memory.
+
+Example usage:
+
+    $ python benchmarks/bulk_create.py --sizes 100 1000 10000 100000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    INSTALLED_APPS=('django.contrib.auth', 'django.contrib.contenttypes', 'm2m_history', 'instagram_api'),
+    SOCIAL_API_TOKENS_STORAGES=[],
+    SOCIAL_API_INSTAGRAM_CLIENT_ID='',
+    SOCIAL_API_INSTAGRAM_CLIENT_SECRET='',
+)
+
+import django
+
+django.setup()
+
+from django.core.management import call_command
+from instagram_api.models import User
+
+
+def check_queryset(ids):
+    # in older SQLite versions this query fails for more than 999 ids
+    ids_exists = User.objects.filter(id__in=ids).values_list('id', flat=True)
+    return [id for id in ids if id not in ids_exists]
+
+
+def check_set(ids):
+    ids_exists = User.remote.get_existing_values('id', ids)
+    return [id for id in ids if id not in ids_exists]
+
+
+def run(name, check, ids, timeout):
+    start = time.time()
+    result = check(ids)
+    duration = time.time() - start
+    print('%-10s %8d ids %10.3f sec %8d new' % (name, len(ids), duration, len(result)))
+    return duration < timeout
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of existence check of bulk_create_from_instances.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="skip bigger sizes of implementation after slower run")
+    args = parser.parse_args()
+
+    call_command('migrate', verbosity=0)
+    User.objects.bulk_create([User(id=id, username='user%d' % id) for id in range(0, max(args.sizes), 2)],
+                             batch_size=500)
+
+    checks = [('queryset', check_queryset), ('set', check_set)]
+    for size in args.sizes:
+        ids = list(range(size))
+        for name, check in list(checks):
+            if not run(name, check, ids, args.timeout):
+                checks.remove((name, check))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark of sanitization of string fields of instances before saving.
+Compares loop over all fields of each instance (previous implementation of InstagramModel.save) with plan of string
+fields compiled once per class, per instance and in bulk by InstagramModel.sanitize_many.
+
+Example usage:
+
+    $ python benchmarks/sanitize.py --rows 10000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    INSTALLED_APPS=('django.contrib.auth', 'django.contrib.contenttypes', 'm2m_history', 'instagram_api'),
+    SOCIAL_API_TOKENS_STORAGES=[],
+    SOCIAL_API_INSTAGRAM_CLIENT_ID='',
+    SOCIAL_API_INSTAGRAM_CLIENT_SECRET='',
+)
+
+import django
+
+django.setup()
+
+import six
+from django.db import models
+from instagram_api.models import User
+
+
+def sanitize_fields(instance):
+    cut = False
+    for field in instance._meta.fields:
+        if isinstance(field, (models.CharField, models.TextField)):
+            value = getattr(instance, field.name)
+            if isinstance(field, models.CharField) and value:
+                if len(value) > field.max_length:
+                    value = value[:field.max_length]
+                    cut = True
+            if isinstance(value, six.string_types):
+                while True:
+                    try:
+                        value.encode('utf-16').decode('utf-16')
+                        break
+                    except UnicodeDecodeError:
+                        if cut and len(value) > 2:
+                            value = value[:-1]
+                        else:
+                            value = ''
+                            break
+            setattr(instance, field.name, value)
+
+
+def sanitize_each(instances):
+    for instance in instances:
+        sanitize_fields(instance)
+
+
+def sanitize_plan(instances):
+    for instance in instances:
+        instance._sanitize()
+
+
+def sanitize_many(instances):
+    User.sanitize_many(instances)
+
+
+def make_users(rows):
+    return [User(id=id, username=u'user%d' % id, full_name=u'Full Name \u2728 %d' % id * (id % 10 + 1),
+                 bio=u'Biography of user %d' % id * 3, website=u'http://example.com/%d' % id,
+                 profile_picture=u'http://example.com/%d.jpg' % id) for id in range(rows)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of sanitization of string fields of instances.")
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for name, sanitize in [('fields', sanitize_each), ('plan', sanitize_plan), ('many', sanitize_many)]:
+        durations = []
+        for i in range(args.repeat):
+            users = make_users(args.rows)
+            start = time.time()
+            sanitize(users)
+            durations += [time.time() - start]
+        duration = min(durations)
+        print('%-10s %8d rows %10.3f sec %8.2f usec per row' % (name, args.rows, duration,
+                                                                duration / args.rows * 1000000))
+
+
+if __name__ == '__main__':
+    main()
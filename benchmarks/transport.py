@@ -0,0 +1,116 @@
+"""
+Benchmark of HTTP transports against local stub server.
+Compares new httplib2.Http for each call (default behaviour of python-instagram) with keep-alive pooled transport
+and counts TCP connections (handshakes) accepted by the server. Option --tls serves stub over HTTPS with self-signed
+certificate generated by openssl.
+
+Example usage:
+
+    $ python benchmarks/transport.py --calls 1000 --tls
+"""
+import argparse
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+
+settings.configure()
+
+from httplib2 import Http
+from instagram_api.transport import PooledTransport
+
+CONTENT = '{"meta": {"code": 200}, "data": {"id": "1", "username": "stub"}}'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # write response in one packet, flushed after each request
+    wbufsize = -1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(CONTENT)))
+        self.end_headers()
+        self.wfile.write(CONTENT)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+    certfile = keyfile = None
+
+    def get_request(self):
+        request, client_address = HTTPServer.get_request(self)
+        if self.certfile:
+            request = ssl.wrap_socket(request, server_side=True, certfile=self.certfile, keyfile=self.keyfile)
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        return ThreadingMixIn.process_request(self, request, client_address)
+
+    def handle_error(self, request, client_address):
+        # clients close connections without TLS shutdown
+        pass
+
+
+def run(name, request, server, url, calls):
+    server.connections = 0
+    start = time.time()
+    for i in range(calls):
+        response, content = request(url)
+        assert response['status'] == '200'
+    duration = time.time() - start
+    print('%-10s %6d calls %8.3f sec %8.3f ms/call %6d connections' % (
+        name, calls, duration, duration * 1000 / calls, server.connections))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of HTTP transports.")
+    parser.add_argument('--calls', type=int, default=1000)
+    parser.add_argument('--tls', action='store_true')
+    args = parser.parse_args()
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    scheme = 'http'
+    if args.tls:
+        scheme = 'https'
+        tempdir = tempfile.mkdtemp()
+        server.certfile = os.path.join(tempdir, 'cert.pem')
+        server.keyfile = os.path.join(tempdir, 'key.pem')
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                               '-subj', '/CN=127.0.0.1', '-keyout', server.keyfile, '-out', server.certfile],
+                              stderr=open(os.devnull, 'w'))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = '%s://127.0.0.1:%d/v1/users/1.json' % (scheme, server.server_address[1])
+
+    run('httplib2', lambda url: Http(disable_ssl_certificate_validation=True).request(url, 'GET'),
+        server, url, args.calls)
+    transport = PooledTransport()
+    transport.session.verify = transport.session.trust_env = False
+    run('pooled', transport.request, server, url, args.calls)
+
+    transport.close()
+    server.shutdown()
+    if args.tls:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,50 @@
+import hashlib
 import logging
-from time import sleep
+import random
+import sys
+import threading
+import urlparse
+from collections import Counter, deque, OrderedDict
+from copy import deepcopy
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
 
+import six
+from six.moves.queue import Queue, Full
 from django.conf import settings
+from django.db import connection
 from instagram import InstagramAPIError as InstagramError, InstagramClientError
 from instagram.client import InstagramAPI
-from social_api.api import ApiAbstractBase, Singleton
+from instagram.oauth2 import OAuth2Request
+from requests.exceptions import Timeout
+from social_api.api import ApiAbstractBase, NoActiveTokens, Singleton
 
-__all__ = ['get_api', ]
+from .transport import get_transport, add_url_parameters, SECRET_PARAMETERS
+
+__all__ = ['get_api', 'TokenPool', 'ThreadSingleton', 'ResponseCache', 'response_cache', 'RetryPolicy',
+           'CircuitBreaker', 'CircuitOpenError', 'MetricsRegistry', 'metrics', 'SingleFlight', 'singleflight',
+           'submit', 'api_call_async', 'iter_async']
 
 CLIENT_ID = getattr(settings, 'SOCIAL_API_INSTAGRAM_CLIENT_ID')
 CLIENT_SECRET = getattr(settings, 'SOCIAL_API_INSTAGRAM_CLIENT_SECRET')
 
+# requests budget of each access token in sliding window of seconds
+RATE_LIMIT = getattr(settings, 'SOCIAL_API_INSTAGRAM_RATE_LIMIT', 5000)
+RATE_LIMIT_WINDOW = getattr(settings, 'SOCIAL_API_INSTAGRAM_RATE_LIMIT_WINDOW', 3600)
+# max time token stays blocked after rate limit error from the server
+RATE_LIMIT_COOLDOWN = getattr(settings, 'SOCIAL_API_INSTAGRAM_RATE_LIMIT_COOLDOWN', 600)
+# number of threads for concurrent requests
+WORKERS = getattr(settings, 'SOCIAL_API_INSTAGRAM_WORKERS', 10)
+# cache of responses, disabled by default. Example: {'ttl': {'user': 300}, 'size': 1000, 'backend': 'default'}
+CACHE = getattr(settings, 'SOCIAL_API_INSTAGRAM_CACHE', {})
+# exponential backoff of server errors: delay of attempt N is random in range from 0 to min(cap, base * 2 ** N)
+RETRY_BASE = getattr(settings, 'SOCIAL_API_INSTAGRAM_RETRY_BASE', 1)
+RETRY_CAP = getattr(settings, 'SOCIAL_API_INSTAGRAM_RETRY_CAP', 60)
+RETRY_MAX_ATTEMPTS = getattr(settings, 'SOCIAL_API_INSTAGRAM_RETRY_MAX_ATTEMPTS', 10)
+# circuit of endpoint opens after number of server errors in a row and lets probe call after timeout
+CIRCUIT_THRESHOLD = getattr(settings, 'SOCIAL_API_INSTAGRAM_CIRCUIT_THRESHOLD', 5)
+CIRCUIT_TIMEOUT = getattr(settings, 'SOCIAL_API_INSTAGRAM_CIRCUIT_TIMEOUT', 60)
+
 log = logging.getLogger('instagram_api')
 
 
@@ -20,25 +54,546 @@ def code(self):
 
 
 InstagramError.code = code
+InstagramClientError.code = code
+
+
+class CircuitOpenError(InstagramClientError):
+    pass
+
+make_request_original = OAuth2Request.make_request
+
+
+def make_request(self, url, method="GET", body=None, headers=None):
+    # use keep-alive pooled transport instead of new httplib2.Http for each request
+    transport = getattr(self.api, 'transport', None)
+    if transport is None:
+        return make_request_original(self, url, method=method, body=body, headers=headers)
+
+    headers = headers or {}
+    if 'User-Agent' not in headers:
+        headers['User-Agent'] = '%s Python Client' % self.api.api_name
+    return transport.request(url, method, body=body, headers=headers)
+
+
+OAuth2Request.make_request = make_request
+
+
+class TokenPool(object):
+    """
+    Scheduler of access tokens. Each token has sliding-window budget of requests,
+    the next request goes to the token with the most budget left.
+    """
+    def __init__(self, limit=RATE_LIMIT, window=RATE_LIMIT_WINDOW, cooldown=RATE_LIMIT_COOLDOWN):
+        self.limit = limit
+        self.window = window
+        self.cooldown = cooldown
+        self.calls = {}
+        self.blocked = {}
+        self.lock = threading.Lock()
+
+    def _get_calls(self, token, now):
+        calls = self.calls.setdefault(token, deque())
+        while calls and calls[0] <= now - self.window:
+            calls.popleft()
+        return calls
+
+    def _get_budget(self, token, now):
+        if self.blocked.get(token, 0) > now:
+            return 0
+        return max(self.limit - len(self._get_calls(token, now)), 0)
+
+    def _get_refill_time(self, token, now):
+        calls = self._get_calls(token, now)
+        refill = calls[0] + self.window if len(calls) >= self.limit else now
+        return max(refill, self.blocked.get(token, 0))
+
+    def budget(self, token):
+        with self.lock:
+            return self._get_budget(token, time())
+
+    def acquire(self, tokens):
+        """
+        Register request for the token with the most budget left and return it.
+        If all tokens are drained return None and number of seconds until the earliest token refills
+        """
+        now = time()
+        with self.lock:
+            budget, token = max([(self._get_budget(token, now), token) for token in tokens])
+            if budget > 0:
+                self.calls[token].append(now)
+                return token, 0
+            return None, max(min([self._get_refill_time(token, now) for token in tokens]) - now, 0)
+
+    def exhaust(self, token):
+        """
+        Block token after rate limit error from the server until it gets free request again
+        """
+        now = time()
+        with self.lock:
+            calls = self._get_calls(token, now)
+            blocked = now + self.cooldown
+            if calls:
+                blocked = min(calls[0] + self.window, blocked)
+            self.blocked[token] = blocked
+
+
+def get_call_context():
+    """
+    Return scope of API call defined by context: client_id mode, access token of context or shared tokens
+    """
+    context = (getattr(settings, 'SOCIAL_API_CALL_CONTEXT', None) or {}).get('instagram') or {}
+    if context.get('use_client_id', False) is True:
+        return 'client_id'
+    token = context.get('token')
+    return hashlib.md5(token).hexdigest() if token else ''
+
+
+def get_call_key(method, args, kwargs):
+    # responses depend on access token, for example is_private of user
+    return 'instagram_api.%s.%s' % (method, hashlib.md5(repr((get_call_context(), args,
+                                                              sorted(kwargs.items())))).hexdigest())
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter and limited number of attempts
+    """
+    def __init__(self, base=RETRY_BASE, cap=RETRY_CAP, max_attempts=RETRY_MAX_ATTEMPTS):
+        self.base = base
+        self.cap = cap
+        self.max_attempts = max_attempts
+
+    def can_retry(self, attempt):
+        return attempt < self.max_attempts
+
+    def get_delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of API endpoint. Opens after `threshold` failures in a row, fails calls fast while open
+    and lets one probe call after `timeout` seconds (half-open state). Successful probe closes the circuit.
+    """
+    def __init__(self, threshold=CIRCUIT_THRESHOLD, timeout=CIRCUIT_TIMEOUT):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened = None
+        self.probed = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        elif time() < self.opened + self.timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            elif state == 'open':
+                return False
+            # let one probe call at a time, consider probe lost after timeout
+            now = time()
+            if self.probed and now < self.probed + self.timeout:
+                return False
+            self.probed = now
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = self.probed = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probed or self.failures >= self.threshold:
+                self.opened = time()
+                self.probed = None
+
+
+class ResponseCache(object):
+    """
+    Cache of API responses with TTL for each method in bounded in-process LRU
+    and optional Django cache backend as shared second tier
+    """
+    def __init__(self, ttl=None, size=1000, backend=None):
+        self.ttl = ttl or {}
+        self.size = size
+        self.backend = backend
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.items)}
+
+    def get_backend(self):
+        from django.core.cache import caches
+        return caches[self.backend]
+
+    def get(self, method, args, kwargs):
+        """
+        Return tuple of flag if response was found and copy of cached response
+        """
+        if method not in self.ttl:
+            return False, None
+
+        key = get_call_key(method, args, kwargs)
+        with self.lock:
+            if key in self.items:
+                expires, response = self.items.pop(key)
+                if expires > time():
+                    self.items[key] = (expires, response)
+                    self.hits += 1
+                    return True, deepcopy(response)
+
+        if self.backend:
+            item = self.get_backend().get(key)
+            # local copy expires together with the shared one
+            if item is not None and item[0] > time():
+                self._set(key, *item)
+                with self.lock:
+                    self.hits += 1
+                return True, deepcopy(item[1])
+
+        with self.lock:
+            self.misses += 1
+        return False, None
+
+    def set(self, method, args, kwargs, response):
+        if method not in self.ttl or response is None:
+            return
+
+        key = get_call_key(method, args, kwargs)
+        response = deepcopy(response)
+        expires = time() + self.ttl[method]
+        self._set(key, expires, response)
+        if self.backend:
+            self.get_backend().set(key, (expires, response), self.ttl[method])
+
+    def _set(self, key, expires, response):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (expires, response)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+class MetricsRegistry(object):
+    """
+    Registry of API calls metrics: latency histograms by method, counters of responses by status code,
+    requests by token, fired error handlers, retries and time of sleeping. Renders Prometheus text format.
+    """
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, namespace='instagram_api'):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latency_buckets = {}
+            self.latency_sum = Counter()
+            self.latency_count = Counter()
+            self.responses = Counter()
+            self.tokens = Counter()
+            self.handlers = Counter()
+            self.retries = Counter()
+            self.sleeps = Counter()
+
+    def get_token_label(self, token):
+        # do not expose access token, its first part is id of the user
+        if not token:
+            return ''
+        return token.split('.')[0] if '.' in token else hashlib.md5(token).hexdigest()[:8]
+
+    def observe(self, method, seconds, code, token=None):
+        with self.lock:
+            buckets = self.latency_buckets.setdefault(method, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    buckets[i] += 1
+            self.latency_sum[method] += seconds
+            self.latency_count[method] += 1
+            self.responses[(method, str(code))] += 1
+            self.tokens[self.get_token_label(token)] += 1
+
+    def inc_handler(self, handler):
+        with self.lock:
+            self.handlers[handler] += 1
+
+    def inc_retry(self, method):
+        with self.lock:
+            self.retries[method] += 1
+
+    def add_sleep(self, reason, seconds):
+        with self.lock:
+            self.sleeps[reason] += seconds
+
+    def render(self):
+        """
+        Return metrics in Prometheus text exposition format
+        """
+        def labels(**kwargs):
+            return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for k, v in sorted(kwargs.items())])
+
+        def header(name, kind, help):
+            return ['# HELP %s_%s %s' % (self.namespace, name, help),
+                    '# TYPE %s_%s %s' % (self.namespace, name, kind)]
+
+        def counter(name, help, values, label):
+            lines = header(name, 'counter', help)
+            for key, value in sorted(values.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                lines += ['%s_%s%s %s' % (self.namespace, name, labels(**dict(zip(label, key))), value)]
+            return lines
+
+        with self.lock:
+            lines = header('request_duration_seconds', 'histogram', 'Duration of API requests.')
+            for method, buckets in sorted(self.latency_buckets.items()):
+                name = '%s_request_duration_seconds' % self.namespace
+                for bound, value in zip(self.buckets, buckets):
+                    lines += ['%s_bucket%s %d' % (name, labels(method=method, le=bound), value)]
+                lines += ['%s_bucket%s %d' % (name, labels(method=method, le='+Inf'), self.latency_count[method]),
+                          '%s_sum%s %s' % (name, labels(method=method), self.latency_sum[method]),
+                          '%s_count%s %d' % (name, labels(method=method), self.latency_count[method])]
+            lines += counter('responses_total', 'API responses by status code.', self.responses, ('method', 'code'))
+            lines += counter('token_requests_total', 'API requests by access token.', self.tokens, ('token',))
+            lines += counter('error_handlers_total', 'Fired error handlers.', self.handlers, ('handler',))
+            lines += counter('retries_total', 'Repeated API calls.', self.retries, ('method',))
+            lines += counter('sleep_seconds_total', 'Time of sleeping before API calls.', self.sleeps, ('reason',))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+class SingleFlightCall(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalescing of identical calls in flight: concurrent callers with the same key wait for the first one
+    and get copies of its result
+    """
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlightCall()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error:
+                six.reraise(*call.error)
+            return deepcopy(call.result)
+
+        result = None
+        try:
+            result = func(*args, **kwargs)
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+                waiters = call.waiters
+            if waiters and call.error is None:
+                # result is mutated by parsing, waiters get copies of untouched one
+                call.result = deepcopy(result)
+            call.event.set()
+        return result
+
+
+singleflight = SingleFlight()
+
+
+class ThreadSingleton(Singleton):
+    """
+    Singleton metaclass with separate instance for each thread,
+    because API instance keeps state of the current call
+    """
+    def __init__(cls, name, bases, dictionary):
+        super(ThreadSingleton, cls).__init__(name, bases, dictionary)
+        cls.local = threading.local()
+
+    def __call__(cls, *args, **kwargs):
+        instance = getattr(cls.local, 'instance', None)
+        if instance is None:
+            instance = cls.local.instance = super(Singleton, cls).__call__(*args, **kwargs)
+        return instance
 
 
 class InstagramApi(ApiAbstractBase):
-    __metaclass__ = Singleton
+    __metaclass__ = ThreadSingleton
 
     provider = 'instagram'
     error_class = (InstagramError, InstagramClientError)
+    error_class_repeat = ApiAbstractBase.error_class_repeat + (Timeout,)
+    token_pool = TokenPool()
+    token = None
+    retry_policy = RetryPolicy()
+    attempt = 0
+    circuit_breakers = {}
+    circuit_breakers_lock = threading.Lock()
+    server_error_codes = (500, 502, 503)
+    metrics = metrics
 
     def get_api(self, token):
+        self.token = token
         context = getattr(settings, 'SOCIAL_API_CALL_CONTEXT', None)
         if context and self.provider in context and context[self.provider].get('use_client_id', False) is True:
             kwargs = {'client_id': CLIENT_ID}
         else:
             kwargs = {'access_token': token, 'client_secret': CLIENT_SECRET}
 
-        return InstagramAPI(**kwargs)
+        api = InstagramAPI(**kwargs)
+        api.transport = get_transport()
+        return api
+
+    def get_active_tokens(self):
+        if self.consistent_token and self.consistent_token not in self.used_access_tokens:
+            return [self.consistent_token]
+
+        self.tokens = self.get_tokens()
+        if not self.tokens:
+            self.update_tokens()
+            self.tokens = self.get_tokens()
+            if not self.tokens:
+                raise NoActiveTokens("There is no active tokens for provider %s after updating" % self.provider)
+
+        tokens = [token for token in self.tokens if token not in self.used_access_tokens]
+        if not tokens:
+            raise NoActiveTokens("There is no active tokens for provider %s, used_tokens: %s"
+                                 % (self.provider, self.used_access_tokens))
+        return tokens
+
+    def get_token(self):
+        tokens = self.get_active_tokens()
+        while True:
+            token, wait = self.token_pool.acquire(tokens)
+            if token:
+                return token
+            log.warning("All access tokens are rate limited, need to wait %.2f sec" % wait)
+            self.metrics.add_sleep('rate_limit', wait)
+            sleep(wait)
+
+    @classmethod
+    def reset_circuit_breakers(cls):
+        """
+        Close circuits of all methods, for example between tests
+        """
+        with cls.circuit_breakers_lock:
+            cls.circuit_breakers.clear()
+
+    def get_circuit_breaker(self, method):
+        with self.circuit_breakers_lock:
+            if method not in self.circuit_breakers:
+                self.circuit_breakers[method] = CircuitBreaker()
+            return self.circuit_breakers[method]
+
+    def call(self, method, *args, **kwargs):
+        if not self.get_circuit_breaker(method).allow():
+            raise CircuitOpenError("Circuit of method %s is open because of server errors" % method, status_code=503)
+        return super(InstagramApi, self).call(method, *args, **kwargs)
 
     def get_api_response(self, *args, **kwargs):
-        return getattr(self.api, self.method)(*args, **kwargs)
+        if kwargs.get('with_next_url'):
+            kwargs['with_next_url'] = self.sign_next_url(kwargs['with_next_url'])
+        breaker = self.get_circuit_breaker(self.method)
+        start = time()
+        try:
+            response = getattr(self.api, self.method)(*args, **kwargs)
+        except self.error_class as e:
+            self.metrics.observe(self.method, time() - start, self.get_error_code(e), self.token)
+            if self.is_server_error(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        except self.error_class_repeat as e:
+            # network errors on the client side are not failures of the endpoint and don't open the circuit
+            self.metrics.observe(self.method, time() - start, type(e).__name__, self.token)
+            raise
+        self.metrics.observe(self.method, time() - start, 200, self.token)
+        breaker.record_success()
+        return response
+
+    def sign_next_url(self, url):
+        """
+        Add credentials of the current API client to url of the next page saved without them
+        """
+        query = urlparse.parse_qs(urlparse.urlsplit(url).query)
+        if any([name in query for name in SECRET_PARAMETERS]):
+            return url
+        elif self.api.access_token:
+            return add_url_parameters(url, access_token=self.api.access_token)
+        return add_url_parameters(url, client_id=self.api.client_id)
+
+    def handle_error_code(self, e, *args, **kwargs):
+        handler = 'handle_error_code_%s' % self.get_error_code(e)
+        self.metrics.inc_handler(handler if hasattr(self, handler) else 'log_and_raise')
+        return super(InstagramApi, self).handle_error_code(e, *args, **kwargs)
+
+    def handle_error_repeat(self, e, *args, **kwargs):
+        self.metrics.inc_handler('handle_error_repeat')
+        return self.handle_server_error(e, *args, **kwargs)
+
+    def handle_error_no_active_tokens(self, e, *args, **kwargs):
+        self.metrics.inc_handler('handle_error_no_active_tokens')
+        return super(InstagramApi, self).handle_error_no_active_tokens(e, *args, **kwargs)
+
+    def sleep_repeat_call(self, *args, **kwargs):
+        seconds = kwargs.pop('seconds', 1)
+        self.metrics.add_sleep('repeat', seconds)
+        sleep(seconds)
+        return self.repeat_call(*args, **kwargs)
+
+    def repeat_call(self, *args, **kwargs):
+        self.metrics.inc_retry(self.method)
+        return super(InstagramApi, self).repeat_call(*args, **kwargs)
+
+    def is_server_error(self, e):
+        if self.is_rate_limit_error(e):
+            return False
+        try:
+            return int(self.get_error_code(e)) in self.server_error_codes
+        except (TypeError, ValueError):
+            return False
+
+    def is_rate_limit_error(self, e):
+        # InstagramAPIError: (503) Rate limited-Your client is making too many request per second
+        return str(self.get_error_code(e)) == '503' and getattr(e, 'error_type', None) == 'Rate limited'
 
     def handle_error_code_400(self, e, *args, **kwargs):
         # OAuthAccessTokenException-The access_token provided is invalid.
@@ -53,25 +608,135 @@ class InstagramApi(ApiAbstractBase):
 
     def handle_error_code_500(self, e, *args, **kwargs):
         # InstagramClientError: (500) Unable to parse response, not valid JSON.
-        return self.sleep_repeat_call(*args, **kwargs)
+        return self.handle_server_error(e, *args, **kwargs)
 
     def handle_error_code_502(self, e, *args, **kwargs):
         # InstagramClientError: (502) Unable to parse response, not valid JSON.
-        return self.sleep_repeat_call(*args, **kwargs)
+        return self.handle_server_error(e, *args, **kwargs)
 
     def handle_error_code_503(self, e, *args, **kwargs):
-        return self.sleep_repeat_call(*args, **kwargs)
+        if self.is_rate_limit_error(e):
+            return self.handle_rate_limit_error(e, *args, **kwargs)
+        return self.handle_server_error(e, *args, **kwargs)
+
+    def handle_server_error(self, e, *args, **kwargs):
+        if not self.retry_policy.can_retry(self.attempt):
+            return self.log_and_raise(e, *args, **kwargs)
+
+        delay = self.retry_policy.get_delay(self.attempt)
+        self.attempt += 1
+        log.warning("Error '%s' of method %s, attempt %d, need to wait %.2f sec" % (e, self.method, self.attempt, delay))
+        self.metrics.add_sleep('server_error', delay)
+        sleep(delay)
+        return self.repeat_call(*args, **kwargs)
 
     def handle_rate_limit_error(self, e, *args, **kwargs):
-        self.used_access_tokens += [self.api.access_token]
-        if len(self.used_access_tokens) == len(self.tokens):
-            log.warning("All access tokens are rate limited, need to wait 600 sec")
-            sleep(600)
-            self.used_access_tokens = []
-        return self.sleep_repeat_call(*args, **kwargs)
+        # token is blocked until it refills, get_token() waits only if all tokens are drained
+        self.token_pool.exhaust(self.token)
+        return self.repeat_call(*args, **kwargs)
+
 
+response_cache = ResponseCache(**CACHE)
 
-def api_call(*args, **kwargs):
+
+def api_call(method, *args, **kwargs):
+    cached, response = response_cache.get(method, args, kwargs)
+    if cached:
+        return response
+    return singleflight.do(get_call_key(method, args, kwargs), call_api, method, *args, **kwargs)
+
+
+def call_api(method, *args, **kwargs):
     api = InstagramApi()
     api.used_access_tokens = []
-    return api.call(*args, **kwargs)
+    api.attempt = 0
+    response = api.call(method, *args, **kwargs)
+    response_cache.set(method, args, kwargs, response)
+    return response
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Return pool of threads for non-blocking calls shared by the process
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPool(WORKERS)
+    return _executor
+
+
+def submit(func, *args, **kwargs):
+    """
+    Call function in the shared pool of threads, return AsyncResult
+    """
+    return get_executor().apply_async(_call_in_thread, (func,) + args, kwargs)
+
+
+def _call_in_thread(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # every thread opens its own DB connection, threads of the pool live as long as the process
+        connection.close()
+
+
+def api_call_async(method, *args, **kwargs):
+    """
+    Make API call in the shared pool of threads, return AsyncResult
+    """
+    return submit(api_call, method, *args, **kwargs)
+
+
+def iter_async(iterable, size=1):
+    """
+    Iterate over iterable in the background thread, keeping up to `size` next items ready
+    """
+    queue = Queue(size)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return not stopped.is_set()
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception:
+            put((end, sys.exc_info()))
+        else:
+            put((end, None))
+        finally:
+            # thread is started for every iteration and opens its own DB connection
+            connection.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, error = queue.get()
+            if error:
+                six.reraise(*error)
+            elif item is end:
+                return
+            yield item
+    finally:
+        stopped.set()
+        # wake up producer waiting for free place in the queue
+        while not queue.empty():
+            queue.get_nowait()
@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
+import sqlite3
+from array import array
+
+import simplejson as json
+from django.db import connections
 from django.utils.functional import wraps
 from django.db.models.query import QuerySet
+import six
+
+from .diff import ID_TYPECODE
 
 try:
     from django.db.transaction import atomic
@@ -24,11 +32,31 @@ def opt_arguments(func):
             return meta_func
     return meta_wrapper
 
+def filter_pks(queryset, pks):
+    """
+    Filter queryset by primary keys. On PostgreSQL and SQLite with JSON functions all keys are passed
+    by one parameter of the statement, otherwise number of keys is limited by parameters limit of database
+    """
+    if not len(pks):
+        return queryset.none()
+    pks = list(pks)
+    opts = queryset.model._meta
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    column = '%s.%s' % (qn(opts.db_table), qn(opts.pk.column))
+    if connection.vendor == 'postgresql':
+        return queryset.extra(where=['%s = ANY(%%s)' % column], params=[pks])
+    elif connection.vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 38, 0):
+        return queryset.extra(where=['%s IN (SELECT value FROM json_each(%%s))' % column], params=[json.dumps(pks)])
+    return queryset.filter(pk__in=pks)
+
+
 @opt_arguments
 def fetch_all(func, return_all=None, always_all=False):
     """
-    Class method decorator for fetching all items. Add parameter `all=False` for decored method.
+    Class method decorator for fetching all items. Add parameters `all=False` and `stream=False` for decored method.
     If `all` is True, method runs as many times as it returns any results.
+    If `stream` is True, method returns generator of pages, each page is fetched on demand.
     Decorator receive parameters:
       * callback method `return_all`. It's called with the same parameters
         as decored method after all itmes are fetched.
@@ -40,38 +68,57 @@ def fetch_all(func, return_all=None, always_all=False):
         def fetch_something(self, ..., *kwargs):
         ....
     """
-    def wrapper(self, all=False, instances_all=None, **kwargs):
-        response = {}
+    def call(self, **kwargs):
         instances = func(self, **kwargs)
+        response = {}
         if len(instances) == 2 and isinstance(instances, tuple):
             instances, response = instances
+        if not isinstance(instances, (QuerySet, list)):
+            raise ValueError("Wrong type of response from func %s. It should be QuerySet or list, not a %s" % (
+                func, type(instances)))
+        return instances, response
+
+    def pages(self, **kwargs):
+        page_kwargs = kwargs
+        while True:
+            instances, response = call(self, **page_kwargs)
+            yield instances
 
-        if always_all or all:
+            next_url = response['pagination'].get('next_url', None)
+            if not next_url:
+                break
+            page_kwargs = dict(kwargs, next_url=next_url)
+
+    def wrapper(self, all=False, stream=False, **kwargs):
+        if stream:
+            return pages(self, **kwargs)
+
+        if not (always_all or all):
+            return call(self, **kwargs)[0]
+
+        instances_all = None
+        pks = None
+        for instances in pages(self, **kwargs):
             if isinstance(instances, QuerySet):
                 if instances_all is None:
                     instances_all = instances.none()
-                instances_count = instances.count()
-                if instances_count:
-                    instances_all |= instances
-            elif isinstance(instances, list):
+                # keep only primary keys instead of OR-ed chain of querysets, integer keys are kept in array
+                for pk in instances.values_list('pk', flat=True).iterator():
+                    if pks is None:
+                        pks = array(ID_TYPECODE) if isinstance(pk, six.integer_types) else []
+                    pks.append(pk)
+            else:
                 if instances_all is None:
                     instances_all = []
-                instances_count = len(instances)
                 instances_all += instances
-            else:
-                raise ValueError("Wrong type of response from func %s. It should be QuerySet or list, not a %s" % (func, type(instances)))
-
-            next_url = response['pagination'].get('next_url', None)
-            if next_url:
-                return wrapper(self, all=True, next_url=next_url, instances_all=instances_all, **kwargs)
 
-            if return_all:
-                kwargs['instances'] = instances_all
-                return return_all(self, **kwargs)
-            else:
-                return instances_all
+        if isinstance(instances_all, QuerySet) and pks:
+            instances_all = filter_pks(instances_all.model._default_manager.all(), pks)
 
+        if return_all:
+            kwargs['instances'] = instances_all
+            return return_all(self, **kwargs)
         else:
-            return instances
+            return instances_all
 
     return wraps(func)(wrapper)
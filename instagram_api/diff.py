@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import bisect
+import sys
+import zlib
+from array import array
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['id_array', 'difference', 'diff_ids', 'union', 'intersection', 'contains', 'pack_ids', 'unpack_ids']
+
+# typecode of 64-bit signed integers, 'q' is not supported by array of python 2
+try:
+    ID_TYPECODE = array('q').typecode
+except ValueError:
+    ID_TYPECODE = 'l'
+
+
+def id_array(ids):
+    """
+    Return sorted array of unique int64 ids from iterable, numpy array if numpy is installed
+    """
+    if numpy is not None:
+        return numpy.unique(numpy.fromiter(ids, dtype=numpy.int64))
+    return array(ID_TYPECODE, sorted(set(ids)))
+
+
+def difference(ids, other):
+    """
+    Return sorted array of ids missing in other sorted array of ids
+    """
+    if numpy is not None:
+        return numpy.setdiff1d(ids, other, assume_unique=True)
+    # linear merge of two sorted arrays
+    result = array(ID_TYPECODE)
+    j, count = 0, len(other)
+    for id in ids:
+        while j < count and other[j] < id:
+            j += 1
+        if j == count or other[j] != id:
+            result.append(id)
+    return result
+
+
+def diff_ids(old, new):
+    """
+    Compare sorted arrays of old and new ids, return tuple of arrays (added ids, removed ids)
+    """
+    return difference(new, old), difference(old, new)
+
+
+def union(ids, other):
+    """
+    Return sorted array of ids existing in any of two sorted arrays of ids
+    """
+    if numpy is not None:
+        return numpy.union1d(ids, other)
+    result = array(ID_TYPECODE)
+    i, j = 0, 0
+    while i < len(ids) and j < len(other):
+        if ids[i] < other[j]:
+            result.append(ids[i])
+            i += 1
+        elif ids[i] > other[j]:
+            result.append(other[j])
+            j += 1
+        else:
+            result.append(ids[i])
+            i += 1
+            j += 1
+    result.extend(islice(ids, i, None))
+    result.extend(islice(other, j, None))
+    return result
+
+
+def intersection(ids, other):
+    """
+    Return sorted array of ids existing in both sorted arrays of ids
+    """
+    if numpy is not None:
+        return numpy.intersect1d(ids, other, assume_unique=True)
+    result = array(ID_TYPECODE)
+    j, count = 0, len(other)
+    for id in ids:
+        while j < count and other[j] < id:
+            j += 1
+        if j < count and other[j] == id:
+            result.append(id)
+    return result
+
+
+def contains(ids, id):
+    """
+    Check membership of id in sorted array of ids by binary search
+    """
+    if numpy is not None:
+        index = numpy.searchsorted(ids, id)
+    else:
+        index = bisect.bisect_left(ids, id)
+    return index < len(ids) and ids[index] == id
+
+
+def pack_ids(ids):
+    """
+    Pack sorted array of ids to compressed bytes: deltas of ids as little-endian int64 compressed by zlib
+    """
+    if numpy is not None:
+        deltas = numpy.diff(numpy.asarray(ids, dtype=numpy.int64), prepend=0)
+        return zlib.compress(numpy.asarray(deltas, dtype='<i8').tobytes())
+    deltas = array(ID_TYPECODE, [id - prev for prev, id in zip([0] + list(ids[:-1]), ids)])
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+    return zlib.compress(deltas.tobytes() if hasattr(deltas, 'tobytes') else deltas.tostring())
+
+
+def unpack_ids(data):
+    """
+    Unpack compressed bytes of `pack_ids` to sorted array of ids
+    """
+    data = zlib.decompress(bytes(data))
+    if numpy is not None:
+        return numpy.cumsum(numpy.frombuffer(data, dtype='<i8')).astype(numpy.int64)
+    deltas = array(ID_TYPECODE)
+    if hasattr(deltas, 'frombytes'):
+        deltas.frombytes(data)
+    else:
+        deltas.fromstring(data)
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+    ids = array(ID_TYPECODE)
+    total = 0
+    for delta in deltas:
+        total += delta
+        ids.append(total)
+    return ids
@@ -1,7 +1,42 @@
-import requests
 import time
-import simplejson as json
+from django.conf import settings
 from oauth_tokens.providers.instagram import InstagramAuthRequest
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+
+from .api import iter_async, metrics, RetryPolicy
+from .streaming import JSONArrayStream
+from .transport import get_transport
+
+# bounds of number of nodes in page and latency of request in seconds, page shrinks when it's exceeded
+PAGE_SIZE_MIN = getattr(settings, 'SOCIAL_API_INSTAGRAM_GRAPHQL_PAGE_SIZE_MIN', 100)
+PAGE_SIZE_MAX = getattr(settings, 'SOCIAL_API_INSTAGRAM_GRAPHQL_PAGE_SIZE_MAX', 1000)
+PAGE_LATENCY = getattr(settings, 'SOCIAL_API_INSTAGRAM_GRAPHQL_PAGE_LATENCY', 5)
+# number of nodes decoded from response stream and handed downstream at once
+BATCH_SIZE = getattr(settings, 'SOCIAL_API_INSTAGRAM_GRAPHQL_BATCH_SIZE', 100)
+
+
+class PageSize(object):
+    """
+    Size of page adapted to latency and errors of requests: it grows by `minimum` nodes after fast responses
+    and shrinks by half after slow responses and errors
+    """
+    def __init__(self, minimum=PAGE_SIZE_MIN, maximum=PAGE_SIZE_MAX, latency=PAGE_LATENCY):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency = latency
+        self.limit = maximum
+
+    def record_success(self, seconds):
+        if seconds > self.latency:
+            self.shrink()
+        else:
+            self.limit = min(self.maximum, self.limit + self.minimum)
+
+    def record_failure(self):
+        self.shrink()
+
+    def shrink(self):
+        self.limit = max(self.minimum, self.limit // 2)
 
 
 class GraphQL(object):
@@ -9,13 +44,41 @@ class GraphQL(object):
     url = 'https://www.instagram.com/query/'
     cookies = '__utma=227057989.1129888433.1423302270.1433340455.1434559808.20; __utmc=227057989; mid=VpvY_gAEAAHrA7w3K-gGUZNO3gUn; sessionid=IGSC7c09257a24e6a71806e9f9dc952d22e2aeca0b9a471b86c84c75ffa10511a509%3Avb2zOhH21hwjUVG4UItD2ruVR09hq2tF%3A%7B%22_token_ver%22%3A2%2C%22_auth_user_id%22%3A1687258424%2C%22_token%22%3A%221687258424%3AWd6qVgJRS6fbkEhrfKM1D5xo2XM8YFHk%3Abaa3b7fd09a33cea01f659a626fc6cb738c577ca896390beb5960043ec113298%22%2C%22asns%22%3A%7B%22188.40.74.9%22%3A24940%2C%22time%22%3A1466597282%7D%2C%22_auth_user_backend%22%3A%22accounts.backends.CaseInsensitiveModelBackend%22%2C%22last_refreshed%22%3A1466597282.193233%2C%22_platform%22%3A4%7D; ig_pr=2; ig_vw=1618; csrftoken=CSRF_TOKEN; s_network=; ds_user_id=1687258424'
 
-    def related_users(self, endpoint, user):
+    def related_users_async(self, endpoint, user, prefetch=1, end_cursor=None):
+        """
+        Iterate over pages of related users, fetching next `prefetch` pages in the background thread
+        """
+        return iter_async(self.related_users(endpoint, user, end_cursor), prefetch)
+
+    def related_users_batches_async(self, endpoint, user, prefetch=1, end_cursor=None, size=BATCH_SIZE):
+        """
+        Iterate over batches of related users, decoding next `prefetch` batches in the background thread
+        """
+        return iter_async(self.related_users_batches(endpoint, user, end_cursor, size), prefetch)
+
+    def related_users(self, endpoint, user, end_cursor=None):
+        """
+        Iterate over pages of related users as tuples (nodes, end_cursor), starting after `end_cursor` if defined.
+        end_cursor is None for the last page
+        """
+        nodes = []
+        for batch, page_info in self.related_users_batches(endpoint, user, end_cursor):
+            nodes += batch
+            if page_info is not None:
+                yield nodes, page_info['end_cursor'] if page_info['has_next_page'] else None
+                nodes = []
+
+    def related_users_batches(self, endpoint, user, end_cursor=None, size=BATCH_SIZE):
+        """
+        Iterate over batches of related users as tuples (nodes, page_info), nodes are decoded from response stream.
+        page_info is defined only for the last batch of each page
+        """
         req = InstagramAuthRequest()
-        session = requests.Session()
+        transport = get_transport()
         url = 'https://www.instagram.com/%s/' % user.username
         # response = req.authorized_request('get', url=url)
-        response = session.get(url=url)
-        csrf_token = req.get_csrf_token_from_content(response.content)
+        response, content = transport.request(url)
+        csrf_token = req.get_csrf_token_from_content(content)
         headers = {
             'Referer': url,
             'X-CSRFToken': csrf_token,
@@ -23,12 +86,23 @@ class GraphQL(object):
         }
 
         user_id = user.id
-        limit = 1000
-        method = 'first'
-        args = limit
+        page_size = PageSize()
+        retry_policy = RetryPolicy()
+        attempt = 0
+        # number of nodes of the current page handed downstream before the failure of reading of its response
+        handed = 0
         next_page = True
 
         while next_page:
+            # retried page must contain all nodes already handed downstream
+            limit = max(page_size.limit, handed)
+            if end_cursor:
+                method = 'after'
+                args = '%s, %s' % (end_cursor, limit)
+            else:
+                method = 'first'
+                args = limit
+
             graphql = '''
 ig_user(%(user_id)s) {
     %(endpoint)s.%(method)s(%(args)s) {
@@ -38,19 +112,47 @@ ig_user(%(user_id)s) {
 }''' % locals()
 
             # response = req.authorized_request('post', url=self.url, data={'q': graphql}, headers=headers)
-            response = session.post(url=self.url, data={'q': graphql}, headers=headers)
-            json_response = json.loads(response.content)
+            started = time.time()
+            paused = 0
+            nodes = []
+            try:
+                response, chunks = transport.stream(self.url, 'POST', body={'q': graphql}, headers=headers)
+                stream = JSONArrayStream(chunks, 'nodes')
+                for index, node in enumerate(stream):
+                    if index < handed:
+                        continue
+                    nodes += [node]
+                    if len(nodes) == size:
+                        paused_at = time.time()
+                        yield nodes, None
+                        paused += time.time() - paused_at
+                        handed = index + 1
+                        nodes = []
+                json_response = stream.document
+            except (ChunkedEncodingError, ConnectionError, Timeout):
+                # response is read lazily, so errors of reading are raised while nodes are decoded
+                json_response = None
 
-            if json_response['status'] == 'fail' \
-                    and json_response['message'] == 'Sorry, too many requests. Please try again later.':
-                time.sleep(1)
+            if json_response is None or json_response['status'] == 'fail' \
+                    and json_response.get('message') == 'Sorry, too many requests. Please try again later.':
+                page_size.record_failure()
+                if not retry_policy.can_retry(attempt):
+                    raise Exception('Too many failed graphql requests: "%s", last response: "%s"' % (
+                        graphql, json_response))
+                delay = retry_policy.get_delay(attempt)
+                attempt += 1
+                metrics.add_sleep('graphql', delay)
+                time.sleep(delay)
                 continue
 
-            method = 'after'
+            # time of processing of batches downstream is not latency of the request
+            page_size.record_success(time.time() - started - paused)
+            attempt = 0
+            handed = 0
             try:
-                args = '%s, %s' % (json_response[endpoint]['page_info']['end_cursor'], limit)
-                next_page = json_response[endpoint]['page_info']['has_next_page']
-                # print json_response[endpoint]['count'], len(json_response[endpoint]['nodes']), next_page
-                yield json_response[endpoint]['nodes']
+                page_info = json_response[endpoint]['page_info']
+                end_cursor = page_info['end_cursor']
+                next_page = page_info['has_next_page']
             except KeyError:
                 raise Exception('Unexpected response: "%s" of graphql request: "%s"' % (json_response, graphql))
+            yield nodes, page_info
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instagram_api', '0015_auto_20160711_1646'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaginationCursor',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('manager', models.CharField(max_length=50)),
+                ('method', models.CharField(max_length=50)),
+                ('target', models.CharField(max_length=100)),
+                ('cursor', models.TextField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PaginationCursorPage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('ids', models.BinaryField()),
+                ('cursor', models.ForeignKey(related_name='pages', to='instagram_api.PaginationCursor')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='paginationcursor',
+            unique_together=set([('manager', 'method', 'target')]),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instagram_api', '0016_paginationcursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelationSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('relation', models.CharField(max_length=20)),
+                ('time', models.DateTimeField(db_index=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('ids', models.BinaryField()),
+                ('user', models.ForeignKey(related_name='relation_snapshots', to='instagram_api.User')),
+            ],
+            options={
+                'get_latest_by': 'time',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='relationsnapshot',
+            unique_together=set([('user', 'relation', 'time')]),
+        ),
+    ]
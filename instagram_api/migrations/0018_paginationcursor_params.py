@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instagram_api', '0017_relationsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paginationcursor',
+            name='params',
+            field=models.CharField(default=b'', max_length=32),
+        ),
+    ]
@@ -1,25 +1,36 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
 import calendar
+import hashlib
 import logging
 import re
+import sqlite3
 import time
 import sys
+import zlib
+from array import array
+from multiprocessing.pool import ThreadPool
+from collections import defaultdict, namedtuple, OrderedDict
 import six
 
-from django.db import models
-from django.db.models.fields import FieldDoesNotExist
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, connections, models, router
 from django.db.utils import IntegrityError
 from django.utils import timezone
 from instagram.helper import timestamp_to_datetime
 from instagram.models import ApiModel
 from m2m_history.fields import ManyToManyHistoryField
+from m2m_history.models import ManyToManyHistoryVersion
 from social_api.utils import override_api_context
 
 from . import fields
-from .api import api_call, InstagramError
+from .api import api_call, iter_async, submit, InstagramApi, InstagramError, WORKERS
 from .decorators import atomic
+from . import diff
+from .diff import diff_ids, id_array, ID_TYPECODE
 from .graphql import GraphQL
+from .transport import strip_secret_parameters
 
 try:
     from django.db.models.related import RelatedObject as ForeignObjectRel
@@ -27,20 +38,37 @@ except ImportError:
     # django 1.8 +
     from django.db.models.fields.related import ForeignObjectRel
 
-__all__ = ['User', 'Media', 'Comment', 'InstagramContentError', 'InstagramModel', 'InstagramManager', 'UserManager'
-           'Tag', 'TagManager']
+__all__ = ['User', 'Media', 'Comment', 'InstagramContentError', 'InstagramModel', 'InstagramManager', 'UserManager',
+           'UserRecord', 'Tag', 'TagManager', 'PaginationCursor', 'PageProgress',
+           'RelationSnapshot']
 
 log = logging.getLogger('instagram_api')
 
+# keep snapshots of ids of followers and follows after each crawl
+SNAPSHOTS = getattr(settings, 'SOCIAL_API_INSTAGRAM_SNAPSHOTS', False)
+
+# unpaired surrogates of broken symbols of strings
+SURROGATES = re.compile(u'[\ud800-\udfff]')
+
+# max number of rows in one bulk statement, it's decreased by parameters limit of database
+BULK_BATCH_SIZE = getattr(settings, 'SOCIAL_API_INSTAGRAM_BULK_BATCH_SIZE', 1000)
+
 
 class InstagramContentError(Exception):
     pass
 
 
+# progress of paginated crawl: number of page, saved instances of page, count of saved instances, url of next page
+PageProgress = namedtuple('PageProgress', ['page', 'instances', 'count', 'next_url'])
+
+
 class InstagramManager(models.Manager):
     """
     Instagram Manager for RESTful CRUD operations
     """
+    # fields updated by upsert only together with other changed fields, they are always different
+    upsert_untracked_fields = ('fetched',)
+
     def __init__(self, methods=None, remote_pk=None, *args, **kwargs):
         if methods and len(methods.items()) < 1:
             raise ValueError('Argument methods must contains at least 1 specified method')
@@ -52,11 +80,223 @@ class InstagramManager(models.Manager):
 
         super(InstagramManager, self).__init__(*args, **kwargs)
 
-    def bulk_create_from_instances(self, instances):
-        ids = [instance.id for instance in instances]
-        ids_exists = self.model.objects.filter(id__in=ids).values_list('id', flat=True)
-        instances = [instance for instance in instances if instance.id not in ids_exists]
-        self.model.objects.bulk_create(instances)
+    def bulk_create_from_instances(self, instances, update_fields=None):
+        """
+        Insert new instances in bulk. If `update_fields` is defined, these fields of existing rows are updated
+        by the same statements (upsert). Empty values of nullable fields don't overwrite existing values
+        """
+        if update_fields:
+            return self.bulk_upsert_from_instances(instances, update_fields)
+
+        ids_exists = self.get_existing_values('id', [instance.id for instance in instances])
+        instances_new = []
+        for instance in instances:
+            # set of existing ids is extended to skip duplicates inside of the list
+            if instance.id not in ids_exists:
+                ids_exists.add(instance.id)
+                instances_new += [instance]
+        self.model.objects.bulk_create(instances_new, batch_size=BULK_BATCH_SIZE)
+
+    def get_existing_values(self, name, values):
+        """
+        Return set of values of field `name` existing in DB, queried by chunks under parameters limit of database
+        """
+        values_exists = set()
+        for queryset in self._filter_chunks(name, set(values)):
+            values_exists.update(queryset.values_list(name, flat=True))
+        return values_exists
+
+    def _filter_chunks(self, name, values, using=None):
+        """
+        Iterate over querysets filtered by chunks of `values` of field `name` under parameters limit of database
+        """
+        db = using or router.db_for_read(self.model)
+        values = list(values)
+        batch_size = self._get_batch_size(connections[db], [self.model._meta.get_field(name)], values)
+        for i in range(0, len(values), batch_size):
+            yield self.model.objects.using(db).filter(**{'%s__in' % name: values[i:i + batch_size]})
+
+    def bulk_upsert_from_instances(self, instances, update_fields):
+        if not instances:
+            return
+        instances = self._unique_by_remote_pk(instances)
+        fields = self._get_insert_fields()
+        update_fields = [self.model._meta.get_field(name) for name in update_fields]
+        db = router.db_for_write(self.model)
+
+        if not self._upsert_supported(connections[db]):
+            return self._upsert_fallback(db, instances, update_fields)
+
+        batch_size = self._get_batch_size(connections[db], fields, instances)
+        for i in range(0, len(instances), batch_size):
+            batch = instances[i:i + batch_size]
+            try:
+                with atomic(using=db):
+                    self._upsert_rows(db, fields, self._get_rows(db, fields, batch), update_fields)
+            except IntegrityError as e:
+                # conflict of other unique field, for example username, is resolved by saving one by one
+                log.warning('Bulk upsert of %s failed, saving instances one by one: %s' % (self.model, e))
+                for instance in batch:
+                    self.get_or_create_from_instance(instance)
+
+    def _unique_by_remote_pk(self, items):
+        """
+        Return list of instances or records without duplicates of remote pk, the last duplicate wins.
+        One upsert statement can't affect the same row twice
+        """
+        unique = OrderedDict()
+        for item in items:
+            unique[tuple([getattr(item, name) for name in self.remote_pk])] = item
+        return unique.values()
+
+    def _upsert_supported(self, connection):
+        if connection.vendor == 'postgresql':
+            return connection.pg_version >= 90500
+        elif connection.vendor == 'sqlite':
+            return sqlite3.sqlite_version_info >= (3, 24, 0)
+        return False
+
+    def _get_batch_size(self, connection, fields, instances):
+        return max(1, min(BULK_BATCH_SIZE, connection.ops.bulk_batch_size(fields, instances)))
+
+    def _get_insert_fields(self):
+        return [field for field in self.model._meta.concrete_fields if not isinstance(field, models.AutoField)]
+
+    def _get_rows(self, db, fields, instances):
+        return [[field.get_db_prep_save(field.pre_save(instance, True), connections[db]) for field in fields]
+                for instance in instances]
+
+    def _upsert_rows(self, db, fields, rows, update_fields, coalesce=True):
+        """
+        Execute INSERT ... ON CONFLICT DO UPDATE statement with prepared values of `fields`.
+        Rows are updated only if values of `update_fields` except `upsert_untracked_fields` are changed.
+        If `coalesce` is True, NULL values of nullable fields don't overwrite existing values
+        """
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        distinct = 'IS DISTINCT FROM' if connection.vendor == 'postgresql' else 'IS NOT'
+
+        updates = []
+        changes = []
+        for field in update_fields:
+            column = qn(field.column)
+            value = 'EXCLUDED.%s' % column
+            if coalesce and field.null:
+                value = 'COALESCE(%s, %s.%s)' % (value, table, column)
+            updates += ['%s = %s' % (column, value)]
+            if field.name not in self.upsert_untracked_fields:
+                changes += ['%s.%s %s %s' % (table, column, distinct, value)]
+
+        sql = 'INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s) DO UPDATE SET %s' % (
+            table,
+            ', '.join([qn(field.column) for field in fields]),
+            ', '.join(['(%s)' % ', '.join(['%s'] * len(fields))] * len(rows)),
+            ', '.join([qn(self.model._meta.get_field(name).column) for name in self.remote_pk]),
+            ', '.join(updates))
+        if changes:
+            sql += ' WHERE %s' % ' OR '.join(changes)
+
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql, [value for row in rows for value in row])
+        finally:
+            cursor.close()
+
+    def _upsert_fallback(self, db, instances, update_fields):
+        """
+        Insert new instances in bulk and update changed existing rows one by one
+        """
+        remote_pk = self.remote_pk[0]
+        names = [field.attname for field in update_fields]
+        instances = dict([(getattr(instance, remote_pk), instance) for instance in instances])
+        tracked = [field for field in update_fields if field.name not in self.upsert_untracked_fields]
+
+        rows = []
+        for queryset in self._filter_chunks(remote_pk, instances.keys(), using=db):
+            rows += queryset.values(remote_pk, *names)
+
+        for row in rows:
+            instance = instances.pop(row[remote_pk])
+            values = {}
+            changed = False
+            for field in update_fields:
+                value = getattr(instance, field.attname)
+                if value is None and field.null:
+                    continue
+                if value != row[field.attname]:
+                    values[field.attname] = value
+                    changed = changed or field.name not in self.upsert_untracked_fields
+            if values and (changed or not tracked):
+                self.model.objects.using(db).filter(**{remote_pk: row[remote_pk]}).update(**values)
+
+        self.model.objects.using(db).bulk_create(instances.values(), batch_size=BULK_BATCH_SIZE)
+
+    def parse_response_record(self, record_class, resource, extra_fields=None):
+        """
+        Parse API response into compact record without model instance.
+        Only fields of the record are parsed, they should be simple fields without relations
+        """
+        record = record_class()
+        plan = self.model.get_parse_plan()
+        resource = resource.__dict__ if isinstance(resource, ApiModel) else resource
+        for name in record_class.__slots__:
+            value = resource.get(name)
+            if value:
+                parser, field = plan[name]
+                parser(record, field, name, value)
+        if extra_fields:
+            for name, value in extra_fields.items():
+                setattr(record, name, value)
+        return record
+
+    def bulk_upsert_records(self, records, update_fields):
+        """
+        Insert records in bulk and update `update_fields` of existing rows by the same statements.
+        Fields missing in records get default values of the model
+        """
+        if not records:
+            return
+        records = self._unique_by_remote_pk(records)
+        self.model.sanitize_many(records)
+        db = router.db_for_write(self.model)
+        if not self._upsert_supported(connections[db]):
+            return self.bulk_upsert_from_instances([self._record_to_instance(record) for record in records],
+                                                   update_fields)
+
+        fields = self._get_insert_fields()
+        update_fields = [self.model._meta.get_field(name) for name in update_fields]
+        rows = self._get_record_rows(db, fields, records)
+        batch_size = self._get_batch_size(connections[db], fields, records)
+        for i in range(0, len(rows), batch_size):
+            try:
+                with atomic(using=db):
+                    self._upsert_rows(db, fields, rows[i:i + batch_size], update_fields)
+            except IntegrityError as e:
+                log.warning('Bulk upsert of %s failed, saving records one by one: %s' % (self.model, e))
+                for record in records[i:i + batch_size]:
+                    self.get_or_create_from_instance(self._record_to_instance(record))
+
+    def _get_record_rows(self, db, fields, records):
+        connection = connections[db]
+        names = set(records[0].__slots__)
+        # prepared default values of fields missing in records or empty in record
+        defaults = [field.get_db_prep_save(field.get_default(), connection) for field in fields]
+        columns = [(field, field.attname if field.attname in names else None, default)
+                   for field, default in zip(fields, defaults)]
+
+        rows = []
+        for record in records:
+            row = []
+            for field, name, default in columns:
+                value = getattr(record, name) if name else None
+                row += [default if value is None else field.get_db_prep_save(value, connection)]
+            rows += [row]
+        return rows
+
+    def _record_to_instance(self, record):
+        values = [(name, getattr(record, name)) for name in record.__slots__]
+        return self.model(**dict([(name, value) for name, value in values if value is not None]))
 
     def get_or_create_from_instance(self, instance):
 
@@ -74,32 +314,302 @@ class InstagramManager(models.Manager):
 
         return instance
 
+    def get_or_create_many(self, instances):
+        """
+        Save list of instances in bulk, return QuerySet of them. Existing objects are found by remote pk
+        with one query per batch and substituted in memory, all objects are written by bulk statements
+        """
+        instances = self.save_many(instances)
+        return self.model.objects.filter(pk__in=set([instance.pk for instance in instances]))
+
+    def save_many(self, instances):
+        """
+        Bulk version of get_or_create_from_instance, set primary keys of instances and return them
+        """
+        if not instances:
+            return instances
+
+        self._save_relations_pre_many(instances)
+
+        # the last instance with the same remote pk is saved
+        remote_pk = self.remote_pk[0]
+        instances_unique = OrderedDict([(getattr(instance, remote_pk), instance) for instance in instances])
+        db = router.db_for_write(self.model)
+
+        instances_old = {}
+        for queryset in self._filter_chunks(remote_pk, instances_unique.keys(), using=db):
+            instances_old.update([(getattr(instance, remote_pk), instance) for instance in queryset])
+
+        for key, instance in instances_unique.items():
+            if key in instances_old:
+                instance._substitute(instances_old[key])
+        self.model.sanitize_many(instances_unique.values())
+
+        try:
+            with atomic(using=db):
+                self._write_many(db, instances_unique.values(), instances_old)
+        except IntegrityError as e:
+            # conflict of other unique field, for example username, is resolved by saving one by one
+            log.warning('Bulk saving of %s failed, saving instances one by one: %s' % (self.model, e))
+            for instance in instances_unique.values():
+                self.get_or_create_from_instance(instance)
+        else:
+            self._save_relations_post_many(instances_unique.values())
+
+        for instance in instances:
+            instance.pk = instances_unique[getattr(instance, remote_pk)].pk
+        return instances
+
+    def _write_many(self, db, instances, instances_old):
+        remote_pk = self.remote_pk[0]
+        fields = self._get_insert_fields()
+
+        if self._upsert_supported(connections[db]):
+            update_fields = [field for field in fields if field.name not in self.remote_pk]
+            batch_size = self._get_batch_size(connections[db], fields, instances)
+            for i in range(0, len(instances), batch_size):
+                rows = self._get_rows(db, fields, instances[i:i + batch_size])
+                self._upsert_rows(db, fields, rows, update_fields, coalesce=False)
+        else:
+            instances_new = []
+            for instance in instances:
+                if getattr(instance, remote_pk) in instances_old:
+                    values = dict([(field.attname, getattr(instance, field.attname)) for field in fields])
+                    self.model.objects.using(db).filter(pk=instance.pk).update(**values)
+                else:
+                    instances_new += [instance]
+            self.model.objects.using(db).bulk_create(instances_new, batch_size=BULK_BATCH_SIZE)
+
+        if self.model._meta.pk.name != remote_pk:
+            # primary keys of inserted rows are not returned by bulk statements
+            pks = {}
+            keys = [getattr(instance, remote_pk) for instance in instances if instance.pk is None]
+            for queryset in self._filter_chunks(remote_pk, keys, using=db):
+                pks.update(queryset.values_list(remote_pk, 'pk'))
+            for instance in instances:
+                if instance.pk is None:
+                    instance.pk = pks[getattr(instance, remote_pk)]
+
+    def _save_relations_pre_many(self, instances):
+        """
+        Save related objects of foreign keys of all instances in bulk grouped by model
+        """
+        relations = defaultdict(list)
+        for instance in instances:
+            for field, rel_instance in instance._relations_pre_save:
+                relations[rel_instance.__class__] += [rel_instance]
+
+        for model, rel_instances in relations.items():
+            model.remote.save_many(rel_instances)
+
+        for instance in instances:
+            for field, rel_instance in instance._relations_pre_save:
+                setattr(instance, field, rel_instance)
+            instance._relations_pre_save = []
+
+    def _save_relations_post_many(self, instances):
+        for instance in instances:
+            instance._save_relations_post()
+
+    def bulk_add_m2m(self, field_name, pairs):
+        """
+        Add relations of m2m field `field_name` as pairs (pk of instance, pk of related object) by one statement
+        per batch, existing relations are ignored. Relations of history fields are added with current time.
+        Signals m2m_changed and m2m_history_changed are not sent
+        """
+        pairs = list(set(pairs))
+        if not pairs:
+            return
+
+        field = self.model._meta.get_field(field_name)
+        through = field.rel.through
+        fields = [through._meta.get_field(name) for name in [field.m2m_field_name(), field.m2m_reverse_field_name()]]
+        history = isinstance(field, ManyToManyHistoryField)
+        db = router.db_for_write(through)
+        connection = connections[db]
+
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            return self._bulk_add_m2m_fallback(db, through, fields, history, pairs)
+
+        qn = connection.ops.quote_name
+        table = qn(through._meta.db_table)
+        source, target = [qn(rel_field.column) for rel_field in fields]
+        columns = [source, target]
+        select = ['column1', 'column2']
+        params = []
+        condition = '%s.%s = pairs.column1 AND %s.%s = pairs.column2' % (table, source, table, target)
+        if history:
+            time_from = through._meta.get_field('time_from')
+            columns += [qn(time_from.column)]
+            # placeholder is escaped for formatting of VALUES below
+            select += ['%%s']
+            params += [time_from.get_db_prep_save(timezone.now(), connection)]
+            condition += ' AND %s.%s IS NULL' % (table, qn(through._meta.get_field('time_to').column))
+
+        sql = 'INSERT INTO %s (%s) SELECT %s FROM (VALUES %%s) AS pairs ' \
+              'WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s)' % (
+                  table, ', '.join(columns), ', '.join(select), table, condition)
+
+        batch_size = self._get_batch_size(connection, fields, pairs)
+        cursor = connection.cursor()
+        try:
+            for i in range(0, len(pairs), batch_size):
+                batch = pairs[i:i + batch_size]
+                cursor.execute(sql % ', '.join(['(%s, %s)'] * len(batch)),
+                               params + [value for pair in batch for value in pair])
+        finally:
+            cursor.close()
+
+    def _bulk_add_m2m_fallback(self, db, through, fields, history, pairs):
+        source, target = [rel_field.attname for rel_field in fields]
+        lookup = {'time_to': None} if history else {}
+        sources = list(set([pair[0] for pair in pairs]))
+        batch_size = self._get_batch_size(connections[db], fields[:1], sources)
+
+        pairs_exists = set()
+        for i in range(0, len(sources), batch_size):
+            lookup['%s__in' % source] = sources[i:i + batch_size]
+            pairs_exists.update(through.objects.using(db).filter(**lookup).values_list(source, target))
+
+        extra_fields = {'time_from': timezone.now()} if history else {}
+        through.objects.using(db).bulk_create([through(**dict(extra_fields, **{source: pair[0], target: pair[1]}))
+                                               for pair in pairs if pair not in pairs_exists],
+                                              batch_size=BULK_BATCH_SIZE)
+
+    def set_m2m_history(self, instance, name, ids, time=None):
+        """
+        Replace related objects of history m2m relation `name` of instance with objects with `ids` at `time`.
+        Current and new ids are compared as sorted arrays, removed relations are closed and added relations are
+        inserted by one statement per batch in one transaction. Signals m2m_changed and m2m_history_changed
+        are not sent, version of the relation is saved directly. Return sorted array of new ids
+        """
+        manager = getattr(instance, name)
+        through = manager.through
+        db = manager.db
+        connection = connections[db]
+        source, target, time_from = [through._meta.get_field(field_name)
+                                     for field_name in [manager.source_field_name, manager.target_field_name,
+                                                        'time_from']]
+
+        # closed, inserted relations and version are consistent for readers and after failures
+        with atomic(using=db):
+            current = manager.get_queryset_through().filter(time_to=None)
+            ids_old = id_array(current.values_list(target.attname, flat=True).iterator())
+            ids_new = id_array(ids)
+            added, removed = diff_ids(ids_old, ids_new)
+            time = time or timezone.now()
+
+            batch_size = self._get_batch_size(connection, [target], removed)
+            for i in range(0, len(removed), batch_size):
+                batch = removed[i:i + batch_size].tolist()
+                current.filter(**{'%s__in' % target.attname: batch}).update(time_to=time)
+
+            qn = connection.ops.quote_name
+            sql = 'INSERT INTO %s (%s) VALUES %%s' % (
+                qn(through._meta.db_table), ', '.join([qn(field.column) for field in [source, target, time_from]]))
+            params = [manager._fk_val, time_from.get_db_prep_save(time, connection)]
+            batch_size = self._get_batch_size(connection, [source, target, time_from], added)
+            cursor = connection.cursor()
+            try:
+                for i in range(0, len(added), batch_size):
+                    batch = added[i:i + batch_size].tolist()
+                    cursor.execute(sql % ', '.join(['(%s, %s, %s)'] * len(batch)),
+                                   [value for id in batch for value in (params[0], id, params[1])])
+            finally:
+                cursor.close()
+
+            if not manager.reverse and (len(added) or len(removed)) and self.model._meta.get_field(name).versions:
+                ManyToManyHistoryVersion.objects.using(db).get_or_create(
+                    content_type=ContentType.objects.get_for_model(instance), object_id=instance.pk, field_name=name,
+                    time=time, defaults={'count': len(ids_new), 'added_count': len(added),
+                                         'removed_count': len(removed)})
+        return ids_new
+
     def api_call(self, method, *args, **kwargs):
         if method in self.methods:
             method = self.methods[method]
         return api_call(method, *args, **kwargs)
 
+    def api_call_pages(self, method, *args, **kwargs):
+        """
+        Iterate over pages of paginated API method as tuples (instances, next_url).
+        The next page is fetched in the background thread while the current one is processed.
+        Keyword argument `next_kwargs` contains arguments of calls for the next pages,
+        `next_url` is url of the page to start from instead of the first one
+        """
+        next_kwargs = kwargs.pop('next_kwargs', {})
+        next_url = kwargs.pop('next_url', None)
+
+        def pages():
+            if next_url:
+                instances, _next = self.api_call(method, with_next_url=next_url, **next_kwargs)
+            else:
+                instances, _next = self.api_call(method, *args, **kwargs)
+            yield instances, _next
+            while _next:
+                instances, _next = self.api_call(method, with_next_url=_next, **next_kwargs)
+                yield instances, _next
+
+        return iter_async(pages())
+
+    def get_cursor(self, method, target, resume=True, params=None):
+        """
+        Return checkpoint of paginated crawl of `method` for `target` with arguments of call `params`
+        """
+        return PaginationCursor.objects.get_for(self.__class__.__name__, method, target, resume, params)
+
     def fetch(self, *args, **kwargs):
         """
         Retrieve and save object to local DB
         """
         result = self.get(*args, **kwargs)
         if isinstance(result, list):
-            instances = self.model.objects.none()
-            for instance in result:
-                instance = self.get_or_create_from_instance(instance)
-                instances |= instance.__class__.objects.filter(pk=instance.pk)
-            return instances
+            return self.get_or_create_many(result)
         else:
             return self.get_or_create_from_instance(result)
 
+    def fetch_many(self, ids, workers=WORKERS, **kwargs):
+        """
+        Retrieve objects concurrently by bounded pool of threads and save them to local DB in one pass
+        """
+        ids = list(ids)
+        if not ids:
+            return self.model.objects.none()
+
+        pool = ThreadPool(min(workers, len(ids)))
+        try:
+            result = pool.map(lambda remote_id: self._get_in_thread(remote_id, **kwargs), ids)
+        finally:
+            pool.close()
+            pool.join()
+
+        return self.get_or_create_many([instance for instance in result if instance is not None])
+
+    def _get_in_thread(self, id, **kwargs):
+        if 'extra_fields' in kwargs:
+            kwargs['extra_fields'] = dict(kwargs['extra_fields'])
+        try:
+            return self.get(id, **kwargs)
+        except InstagramApi.error_class + InstagramApi.error_class_repeat as e:
+            # one failed object doesn't abort fetching of others
+            log.error("Error while fetching object %s with id %s: %s" % (self.model, id, e))
+        finally:
+            # every thread opens its own DB connection
+            connection.close()
+
+    def get_async(self, *args, **kwargs):
+        """
+        Retrieve objects from remote server in the shared pool of threads, return AsyncResult
+        """
+        return submit(self.get, *args, **kwargs)
+
     def get(self, *args, **kwargs):
         """
         Retrieve objects from remote server
         """
+        extra_fields = kwargs.pop('extra_fields', {})
         response = self.api_call('get', *args, **kwargs)
 
-        extra_fields = kwargs.pop('extra_fields', {})
         extra_fields['fetched'] = timezone.now()
         return self.parse_response(response, extra_fields)
 
@@ -143,35 +653,67 @@ class InstagramModel(models.Model):
         abstract = True
 
     def save(self, *args, **kwargs):
-        # cut all CharFields to max allowed length
-        cut = False
-        for field in self._meta.fields:
-            if isinstance(field, (models.CharField, models.TextField)):
-                value = getattr(self, field.name)
-                if isinstance(field, models.CharField) and value:
-                    if len(value) > field.max_length:
-                        value = value[:field.max_length]
-                        cut = True
-                if isinstance(value, six.string_types):
-                    # check strings for bad symbols in string encoding
-                    # there is problems to save users with bad encoded strings
-                    while True:
-                        try:
-                            value.encode('utf-16').decode('utf-16')
-                            break
-                        except UnicodeDecodeError:
-                            if cut and len(value) > 2:
-                                value = value[:-1]
-                            else:
-                                value = ''
-                                break
-                setattr(self, field.name, value)
-
+        self._sanitize()
         try:
             super(InstagramModel, self).save(*args, **kwargs)
         except Exception as e:
             six.reraise(type(e), '%s while saving %s' % (str(e), self.__dict__), sys.exc_info()[2])
 
+    def _sanitize(self):
+        self.sanitize_many([self])
+
+    @classmethod
+    def get_sanitize_plan(cls):
+        """
+        Return list of tuples (field name, max length or None) of string fields, it's compiled once per class
+        """
+        if '_sanitize_plan' not in cls.__dict__:
+            cls._sanitize_plan = [(field.name, field.max_length if isinstance(field, models.CharField) else None)
+                                  for field in cls._meta.fields
+                                  if isinstance(field, (models.CharField, models.TextField))]
+        return cls._sanitize_plan
+
+    @classmethod
+    def sanitize_many(cls, instances):
+        """
+        Cut all CharFields of instances or records to max allowed length and clean strings with bad symbols
+        in encoding
+        """
+        # indexes of instances with cut values, the last symbol of them is dropped instead of cleaning of value
+        cut = set()
+        for name, max_length in cls.get_sanitize_plan():
+            for i, instance in enumerate(instances):
+                value = getattr(instance, name, None)
+                if not value:
+                    continue
+                sanitized = value
+                if max_length is not None and len(sanitized) > max_length:
+                    sanitized = sanitized[:max_length]
+                    cut.add(i)
+                # only byte strings and strings with surrogates can fail round trip through utf-16,
+                # there is problems to save users with bad encoded strings
+                if isinstance(sanitized, six.binary_type) or SURROGATES.search(sanitized):
+                    sanitized = clean_encoding(sanitized, i in cut)
+                if sanitized is not value:
+                    setattr(instance, name, sanitized)
+
+
+def clean_encoding(value, cut=False):
+    """
+    Check string for bad symbols in encoding, drop the last symbols of cut string or clean it
+    """
+    if not isinstance(value, six.string_types):
+        return value
+    while True:
+        try:
+            value.encode('utf-16').decode('utf-16')
+            return value
+        except UnicodeDecodeError:
+            if cut and len(value) > 2:
+                value = value[:-1]
+            else:
+                return ''
+
 
 class InstagramBaseModel(InstagramModel):
     _refresh_pk = 'id'
@@ -198,6 +740,11 @@ class InstagramBaseModel(InstagramModel):
         """
         self.pk = old_instance.pk
 
+    def _save_relations_post(self):
+        """
+        Save related instances after current instance, can be overrided in child models
+        """
+
     def save(self, *args, **kwargs):
         """
         Save all related instances before or after current instance
@@ -216,45 +763,30 @@ class InstagramBaseModel(InstagramModel):
         """
         Parse API response and define fields with values
         """
+        plan = self.get_parse_plan()
         for key, value in self._response.items():
-            if key == '_api':
-                continue
-
             try:
-                field, model, direct, m2m = self._meta.get_field_by_name(key)
-            except FieldDoesNotExist:
-                log.debug('Field with name "%s" doesn\'t exist in the model %s' % (key, type(self)))
+                parser, field = plan[key]
+            except KeyError:
+                if key != '_api':
+                    log.debug('Field with name "%s" doesn\'t exist in the model %s', key, type(self))
                 continue
 
             if value:
-                if isinstance(field, ForeignObjectRel):
-                    self._relations_post_save['fk'][key] = [field.model.remote.parse_response_object(item)
-                                                            for item in value]
-                elif isinstance(field, models.ManyToManyField):
-                    self._relations_post_save['m2m'][key] = [field.rel.to.remote.parse_response_object(item)
-                                                             for item in value]
-                else:
-                    if isinstance(field, models.BooleanField):
-                        value = bool(value)
-
-                    elif isinstance(field, (models.OneToOneField, models.ForeignKey)) and value:
-                        rel_instance = field.rel.to.remote.parse_response_object(value)
-                        value = rel_instance
-                        if isinstance(field, models.ForeignKey):
-                            self._relations_pre_save += [(key, rel_instance)]
-
-                    elif isinstance(field, (fields.CommaSeparatedCharField,
-                                            models.CommaSeparatedIntegerField)) and isinstance(value, list):
-                        value = ','.join([unicode(v) for v in value])
+                parser(self, field, key, value)
 
-                    elif isinstance(field, (models.CharField, models.TextField)) and value:
-                        if isinstance(value, (str, unicode)):
-                            value = value.strip()
-
-                    elif isinstance(field, models.IntegerField) and value:
-                        value = int(value)
-
-                    setattr(self, key, value)
+    @classmethod
+    def get_parse_plan(cls):
+        """
+        Return dict of field names and tuples (parser, field) for values of response, it's compiled once per class
+        """
+        if '_parse_plan' not in cls.__dict__:
+            plan = {}
+            for name in cls._meta.get_all_field_names():
+                field = cls._meta.get_field_by_name(name)[0]
+                plan[name] = (get_field_parser(field), field)
+            cls._parse_plan = plan
+        return cls._parse_plan
 
     def get_url(self):
         return 'https://instagram.com/%s' % self.slug
@@ -267,10 +799,80 @@ class InstagramBaseModel(InstagramModel):
         self.__dict__.update(instance.__dict__)
 
 
+def parse_reverse_fk(instance, field, key, value):
+    # model of reverse relation is related_model since django 1.8
+    rel_model = getattr(field, 'related_model', field.model)
+    instance._relations_post_save['fk'][key] = [rel_model.remote.parse_response_object(item) for item in value]
+
+
+def parse_m2m(instance, field, key, value):
+    instance._relations_post_save['m2m'][key] = [field.rel.to.remote.parse_response_object(item) for item in value]
+
+
+def parse_fk(instance, field, key, value):
+    rel_instance = field.rel.to.remote.parse_response_object(value)
+    instance._relations_pre_save += [(key, rel_instance)]
+    setattr(instance, key, rel_instance)
+
+
+def parse_bool(instance, field, key, value):
+    setattr(instance, key, bool(value))
+
+
+def parse_int(instance, field, key, value):
+    setattr(instance, key, int(value))
+
+
+def parse_string(instance, field, key, value):
+    if isinstance(value, six.string_types):
+        value = value.strip()
+    setattr(instance, key, value)
+
+
+def parse_comma_separated(instance, field, key, value):
+    if isinstance(value, list):
+        value = ','.join([six.text_type(v) for v in value])
+    elif isinstance(value, six.string_types):
+        value = value.strip()
+    setattr(instance, key, value)
+
+
+def parse_value(instance, field, key, value):
+    setattr(instance, key, value)
+
+
+def get_field_parser(field):
+    """
+    Return parser of response value for the field
+    """
+    if isinstance(field, ForeignObjectRel):
+        return parse_reverse_fk
+    elif isinstance(field, models.ManyToManyField):
+        return parse_m2m
+    elif isinstance(field, models.BooleanField):
+        return parse_bool
+    elif isinstance(field, models.ForeignKey):
+        return parse_fk
+    elif isinstance(field, (fields.CommaSeparatedCharField, models.CommaSeparatedIntegerField)):
+        return parse_comma_separated
+    elif isinstance(field, (models.CharField, models.TextField)):
+        return parse_string
+    elif isinstance(field, models.IntegerField):
+        return parse_int
+    return parse_value
+
+
 class InstagramSearchManager(InstagramManager):
+    def search_async(self, q=None, **kwargs):
+        """
+        Search objects in the shared pool of threads, return AsyncResult
+        """
+        return submit(self.search, q, **kwargs)
+
     def search(self, q=None, **kwargs):
         if q:
             kwargs['q'] = q
+        extra_fields = kwargs.pop('extra_fields', {})
         instances = self.api_call('search', **kwargs)
 
         if isinstance(instances[0], list) and (len(instances) > 1) and \
@@ -280,13 +882,25 @@ class InstagramSearchManager(InstagramManager):
                 instances_new, _next = self.api_call('search', with_next_url=_next)
                 [instances.append(i) for i in instances_new]
 
-        extra_fields = kwargs.pop('extra_fields', {})
         extra_fields['fetched'] = timezone.now()
 
         return self.parse_response_list(instances, extra_fields)
 
 
+class UserRecord(object):
+    """
+    Compact record of user in pages of related users, it's parsed and written to DB without model instance
+    """
+    __slots__ = ('id', 'username', 'full_name', 'profile_picture', 'bio', 'website', 'fetched')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+
 class UserManager(InstagramSearchManager):
+    # fields of users in lists of followers and follows, updated for existing users
+    related_users_update_fields = ('username', 'full_name', 'profile_picture', 'fetched')
 
     def get(self, *args, **kwargs):
         if 'extra_fields' not in kwargs:
@@ -352,51 +966,99 @@ class UserManager(InstagramSearchManager):
     def fetch_follows(self, user, **kwargs):
         return self.create_related_users('follows', user, **kwargs)
 
-    def create_related_users(self, method, user, **kwargs):
-        if kwargs.pop('source') == 'graphql':
-            ids = self.create_related_users_graphql(method, user)
+    def fetch_followers_many(self, users, **kwargs):
+        return self.create_related_users_many('followed_by', users, **kwargs)
+
+    def fetch_follows_many(self, users, **kwargs):
+        return self.create_related_users_many('follows', users, **kwargs)
+
+    def create_related_users_many(self, method, users, workers=WORKERS, **kwargs):
+        """
+        Crawl related users of many users concurrently by bounded pool of threads.
+        Return dict with ids of users as keys and querysets of related users as values,
+        failed crawls are logged and can be resumed later
+        """
+        users = list(users)
+        if not users:
+            return {}
+
+        def crawl(user):
+            try:
+                return user.pk, self.create_related_users(method, user, **kwargs)
+            except Exception as e:
+                log.error("Error while fetching %s of user %s: %s" % (method, user.pk, e))
+            finally:
+                # every thread opens its own DB connection
+                connection.close()
+
+        pool = ThreadPool(min(workers, len(users)))
+        try:
+            result = pool.map(crawl, users)
+        finally:
+            pool.close()
+            pool.join()
+
+        return dict([item for item in result if item is not None])
+
+    def create_related_users(self, method, user, source='api', resume=True):
+        if source == 'graphql':
+            cursor = self.get_cursor('graphql_%s' % method, user.pk, resume)
+            ids = self.create_related_users_graphql(method, user, cursor)
         else:
-            ids = self.create_related_users_api(method, user)
+            cursor = self.get_cursor(self.methods[method], user.pk, resume)
+            ids = self.create_related_users_api(method, user, cursor)
 
         method = method.replace('followed_by', 'followers')
         m2m_relation = getattr(user, method)
         initial = m2m_relation.versions.count() == 0
-        setattr(user, method, ids)  # user.followers = ids
+        time = timezone.now()
+        ids = self.set_m2m_history(user, method, ids, time)  # user.followers = ids
+        if SNAPSHOTS:
+            RelationSnapshot.objects.create_for(user, method, ids, time)
 
         if initial:
             m2m_relation.get_queryset_through().update(time_from=None)
             m2m_relation.versions.update(added_count=0)
 
+        cursor.finish()
         return m2m_relation.all()
 
-    def create_related_users_api(self, method, user):
-        ids = []
+    def create_related_users_api(self, method, user, cursor):
+        ids = cursor.get_ids()
+        if cursor.finished:
+            return ids
         extra_fiels = {'fetched': timezone.now()}
 
-        _next = True
-        while _next:
-            kwargs = {} if _next is True else {'with_next_url': _next}
-            users = []
-            instances, _next = self.api_call(method, user.pk, **kwargs)
-            for instance in instances:
-                instance = self.parse_response_object(instance, extra_fiels)
-                users += [instance]
-                ids += [instance.id]
-            self.bulk_create_from_instances(users)
+        pages = self.api_call_pages(method, user.pk, next_kwargs={'user_id': user.pk}, next_url=cursor.cursor)
+        for instances, _next in pages:
+            users = [self.parse_response_record(UserRecord, instance, extra_fiels) for instance in instances]
+            page_ids = [record.id for record in users]
+            with atomic():
+                self.bulk_upsert_records(users, self.related_users_update_fields)
+                cursor.checkpoint(_next, len(page_ids), page_ids)
+            ids.extend(page_ids)
         return ids
 
-    def create_related_users_graphql(self, method, user):
+    def create_related_users_graphql(self, method, user, cursor):
+        ids = cursor.get_ids()
+        if cursor.finished:
+            return ids
         graphql = GraphQL()
-        ids = []
         extra_fiels = {'fetched': timezone.now()}
-        for resources in graphql.related_users(method, user):
+        page_ids = array(ID_TYPECODE)
+        for resources, page_info in graphql.related_users_batches_async(method, user, end_cursor=cursor.cursor):
             users = []
-            for instance in resources:
-                instance['profile_picture'] = instance['profile_pic_url']
-                instance = self.parse_response_object(instance, extra_fiels)
-                users += [instance]
-                ids += [instance.id]
-            self.bulk_create_from_instances(users)
+            for resource in resources:
+                resource['profile_picture'] = resource['profile_pic_url']
+                users += [self.parse_response_record(UserRecord, resource, extra_fiels)]
+            page_ids.extend([record.id for record in users])
+            with atomic():
+                self.bulk_upsert_records(users, self.related_users_update_fields)
+                if page_info is not None:
+                    end_cursor = page_info['end_cursor'] if page_info['has_next_page'] else None
+                    cursor.checkpoint(end_cursor, len(page_ids), page_ids)
+                    ids.extend(page_ids)
+                    page_ids = array(ID_TYPECODE)
         return ids
 
     def fetch_media_likes(self, media):
@@ -411,12 +1073,8 @@ class UserManager(InstagramSearchManager):
         response = self.api_call('likes', media.remote_id)
         result = self.parse_response(response, extra_fields)
 
-        instances = []
-        for instance in result:
-            instance = self.get_or_create_from_instance(instance)
-            instances.append(instance)
-
-        media.likes_users = instances + list(media.likes_users.all())
+        instances = self.save_many(result)
+        Media.remote.bulk_add_m2m('likes_users', [(media.pk, instance.pk) for instance in instances])
 
         return media.likes_users.all()
 
@@ -527,8 +1185,58 @@ class User(InstagramBaseModel):
 
 class MediaManager(InstagramManager):
 
+    def _save_relations_post_many(self, instances):
+        """
+        Save comments of all media with their authors and tags in bulk
+        """
+        relations = defaultdict(list)
+        for instance in instances:
+            for field, rel_instances in instance._relations_post_save['fk'].items():
+                extra_fields = {'media_id': instance.pk, 'owner_id': instance.user_id} if field == 'comments' else {}
+                for rel_instance in rel_instances:
+                    rel_instance.__dict__.update(extra_fields)
+                    relations[rel_instance.__class__] += [rel_instance]
+
+        for model, rel_instances in relations.items():
+            model.remote.save_many(rel_instances)
+
+        # related objects of m2m fields are saved in bulk and attached by pairs
+        relations = defaultdict(list)
+        for instance in instances:
+            for field, rel_instances in instance._relations_post_save['m2m'].items():
+                relations[field] += [(instance, rel_instance) for rel_instance in rel_instances]
+
+        for field, pairs in relations.items():
+            rel_instances = [rel_instance for instance, rel_instance in pairs]
+            rel_instances[0].__class__.remote.save_many(rel_instances)
+            self.bulk_add_m2m(field, [(instance.pk, rel_instance.pk) for instance, rel_instance in pairs])
+
     def fetch_user_media(self, user, count=None, min_id=None, max_id=None,
-                         after=None, before=None):
+                         after=None, before=None, resume=True, stream=False):
+        progress = self._fetch_user_media(user, count, min_id, max_id, after, before, resume)
+        return self._consume_pages(progress, stream, user.media_feed.all())
+
+    def fetch_tag_media(self, tag, count=None, max_tag_id=None, resume=True, stream=False):
+        progress = self._fetch_tag_media(tag, count, max_tag_id, resume)
+        return self._consume_pages(progress, stream, tag.media_feed.all())
+
+    def fetch_location_media(self, location, count=None, max_id=None, resume=True, stream=False):
+        progress = self._fetch_location_media(location, count, max_id, resume)
+        return self._consume_pages(progress, stream, location.media_feed.all())
+
+    def _consume_pages(self, progress, stream, result):
+        """
+        If `stream` is True, return generator of PageProgress, each page is fetched, parsed and committed
+        on demand. Crawl stopped by caller is resumed by the next call.
+        Otherwise save all pages and return `result`
+        """
+        if stream:
+            return progress
+        for page in progress:
+            pass
+        return result
+
+    def _fetch_user_media(self, user, count, min_id, max_id, after, before, resume):
 
         extra_fields = {'fetched': timezone.now(), 'user_id': user.pk}
         kwargs = {'user_id': user.pk}
@@ -544,63 +1252,80 @@ class MediaManager(InstagramManager):
         if before:
             kwargs['max_timestamp'] = time.mktime(before.timetuple())
 
-        instances, _next = self.api_call('user_recent_media', **kwargs)
-        while _next:
-            instances_new, _next = self.api_call('user_recent_media', with_next_url=_next)
-            instances_new = sorted(instances_new, reverse=True, key=lambda j: j.created_time)
-            for i in instances_new:
-                instances.append(i)
-                # strange, but API arguments doesn't work
-                if count and len(instances) >= count or after and i.created_time.replace(tzinfo=timezone.utc) <= after:
-                    _next = False
-                    break
+        cursor = self.get_cursor('user_recent_media', user.pk, resume, kwargs)
+        resumed = cursor.pk is not None
+        fetched_count = cursor.count
+        pages = [] if cursor.finished else self.api_call_pages('user_recent_media', next_url=cursor.cursor, **kwargs)
+        for page, (instances, _next) in enumerate(pages):
+            stop = False
+            if page or resumed:
+                instances = sorted(instances, reverse=True, key=lambda j: j.created_time)
+                for index, i in enumerate(instances):
+                    # strange, but API arguments doesn't work
+                    if count and fetched_count + index + 1 >= count \
+                            or after and i.created_time.replace(tzinfo=timezone.utc) <= after:
+                        instances = instances[:index + 1]
+                        stop = True
+                        break
+            fetched_count += len(instances)
 
-        for instance in instances:
-            instance = self.parse_response_object(instance, extra_fields)
-            self.get_or_create_from_instance(instance)
+            with atomic():
+                media = self.save_many([self.parse_response_object(instance, extra_fields) for instance in instances])
+                cursor.checkpoint(_next, len(instances))
+            yield PageProgress(page + 1, media, cursor.count, _next)
 
-        return user.media_feed.all()
+            if stop:
+                break
 
-    def fetch_tag_media(self, tag, count=None, max_tag_id=None):
+        cursor.finish()
+
+    def _fetch_tag_media(self, tag, count, max_tag_id, resume):
 
         extra_fields = {'fetched': timezone.now()}
 
         kwargs = {'tag_name': tag.name, 'count': count, 'max_tag_id': max_tag_id}
-        instances, _next = self.api_call('tag_recent_media', **kwargs)
-        while _next:
-            instances_new, _next = self.api_call('tag_recent_media', with_next_url=_next, tag_name=tag.name)
-            [instances.append(i) for i in instances_new]
-
-        for instance in instances:
-            extra_fields['user_id'] = instance.user.id
-            instance = self.parse_response_object(instance, extra_fields)
-            instance = self.get_or_create_from_instance(instance)
-            instance.tags.add(tag)
+        cursor = self.get_cursor('tag_recent_media', tag.name, resume, kwargs)
+        pages = [] if cursor.finished else self.api_call_pages(
+            'tag_recent_media', next_kwargs={'tag_name': tag.name}, next_url=cursor.cursor, **kwargs)
+        for page, (instances, _next) in enumerate(pages):
+            with atomic():
+                media = []
+                for instance in instances:
+                    extra_fields['user_id'] = instance.user.id
+                    media += [self.parse_response_object(instance, extra_fields)]
+                media = self.save_many(media)
+                self.bulk_add_m2m('tags', [(instance.pk, tag.pk) for instance in media])
+                cursor.checkpoint(_next, len(instances))
+            yield PageProgress(page + 1, media, cursor.count, _next)
 
-        return tag.media_feed.all()
+        cursor.finish()
 
-    def fetch_location_media(self, location, count=None, max_id=None):
+    def _fetch_location_media(self, location, count, max_id, resume):
 
         extra_fields = {'fetched': timezone.now()}
 
         kwargs = {'location_id': location.pk, 'count': count, 'max_id': max_id}
-        instances, _next = self.api_call('location_recent_media', **kwargs)
-        while _next:
-            instances_new, _next = self.api_call('location_recent_media', with_next_url=_next, location_id=location.pk)
-            [instances.append(i) for i in instances_new]
+        next_kwargs = {'location_id': location.pk}
+        cursor = self.get_cursor('location_recent_media', location.pk, resume, kwargs)
+        pages = [] if cursor.finished else self.api_call_pages(
+            'location_recent_media', next_kwargs=next_kwargs, next_url=cursor.cursor, **kwargs)
+        for page, (instances, _next) in enumerate(pages):
+            with atomic():
+                media = []
+                for instance in instances:
+                    extra_fields['user_id'] = instance.user.id
+                    extra_fields['location_id'] = location.pk
+                    media += [self.parse_response_object(instance, extra_fields)]
+                media = self.save_many(media)
+                cursor.checkpoint(_next, len(instances))
+            yield PageProgress(page + 1, media, cursor.count, _next)
 
-        for instance in instances:
-            extra_fields['user_id'] = instance.user.id
-            extra_fields['location_id'] = location.pk
-            instance = self.parse_response_object(instance, extra_fields)
-            self.get_or_create_from_instance(instance)
+        cursor.finish()
 
         if count is None:
             location.media_count = location.media_feed.count()
             location.save()
 
-        return location.media_feed.all()
-
 
 class Media(InstagramBaseModel):
     remote_id = models.CharField(max_length=30, unique=True)
@@ -684,22 +1409,19 @@ class Media(InstagramBaseModel):
     def fetch_likes(self):
         return User.remote.fetch_media_likes(self)
 
-    def save(self, *args, **kwargs):
-        if self.caption is None:
-            self.caption = ''
+    @classmethod
+    def sanitize_many(cls, instances):
+        for instance in instances:
+            if instance.caption is None:
+                instance.caption = ''
+        super(Media, cls).sanitize_many(instances)
 
+    def save(self, *args, **kwargs):
         super(Media, self).save(*args, **kwargs)
+        self._save_relations_post()
 
-        for field, relations in self._relations_post_save['fk'].items():
-            extra_fields = {'media_id': self.pk, 'owner_id': self.user_id} if field == 'comments' else {}
-            for instance in relations:
-                instance.__dict__.update(extra_fields)
-                instance.__class__.remote.get_or_create_from_instance(instance)
-
-        for field, relations in self._relations_post_save['m2m'].items():
-            for instance in relations:
-                instance = instance.__class__.remote.get_or_create_from_instance(instance)
-                getattr(self, field).add(instance)
+    def _save_relations_post(self):
+        Media.remote._save_relations_post_many([self])
 
 
 class CommentManager(InstagramManager):
@@ -709,12 +1431,7 @@ class CommentManager(InstagramManager):
         extra_fields = {'fetched': timezone.now(), 'media_id': media.pk, 'owner_id': media.user_id}
         result = self.parse_response(response, extra_fields)
 
-        instances = self.model.objects.none()
-        for instance in result:
-            instance = self.get_or_create_from_instance(instance)
-            instances |= instance.__class__.objects.filter(pk=instance.pk)
-
-        return instances
+        return self.get_or_create_many(result)
 
 
 class Comment(InstagramBaseModel):
@@ -786,3 +1503,149 @@ class Location(InstagramBaseModel):
         if self._response['point']:
             self.latitude = self._response['point'].latitude
             self.longitude = self._response['point'].longitude
+
+
+class PaginationCursorManager(models.Manager):
+
+    def get_for(self, manager, method, target, resume=True, params=None):
+        """
+        Return saved checkpoint of paginated crawl or new unsaved one.
+        If `resume` is False or saved checkpoint has different arguments of call `params`,
+        it's dropped and crawl starts from the first page
+        """
+        lookup = {'manager': manager, 'method': method, 'target': six.text_type(target)}
+        params = hashlib.md5(repr(sorted((params or {}).items()))).hexdigest()
+        if not resume:
+            self.filter(**lookup).delete()
+        try:
+            cursor = self.get(**lookup)
+        except self.model.DoesNotExist:
+            return self.model(params=params, **lookup)
+        if cursor.params != params:
+            log.warning('Arguments of crawl %s are changed, it starts from the first page' % cursor)
+            cursor.delete()
+            return self.model(params=params, **lookup)
+        return cursor
+
+
+class PaginationCursor(models.Model):
+    """
+    Checkpoint of paginated crawl keyed by (manager, method, target), saved after each committed page
+    """
+    class Meta:
+        unique_together = ('manager', 'method', 'target')
+
+    manager = models.CharField(max_length=50)
+    method = models.CharField(max_length=50)
+    target = models.CharField(max_length=100)
+    # hash of arguments of the first call
+    params = models.CharField(max_length=32, default='')
+
+    # next_url of REST API without credentials or end_cursor of GraphQL, empty after the last page
+    cursor = models.TextField()
+    count = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = PaginationCursorManager()
+
+    def __unicode__(self):
+        return '%s.%s(%s)' % (self.manager, self.method, self.target)
+
+    @property
+    def finished(self):
+        return self.pk is not None and not self.cursor
+
+    def checkpoint(self, cursor, count=0, ids=None):
+        """
+        Save cursor of the next page, should be called in the same transaction with saving of the current page
+        """
+        # access token is added to url of the next page again when crawl is resumed
+        self.cursor = strip_secret_parameters(cursor or '')
+        self.count += count
+        self.save()
+        if ids:
+            self.pages.create(ids=zlib.compress(','.join([str(id) for id in ids])))
+
+    def get_ids(self):
+        """
+        Return array of ids of items of all committed pages
+        """
+        ids = array(ID_TYPECODE)
+        if self.pk is None:
+            return ids
+        for page in self.pages.order_by('pk'):
+            ids.extend([int(id) for id in zlib.decompress(bytes(page.ids)).split(',')])
+        return ids
+
+    def finish(self):
+        if self.pk is not None:
+            self.delete()
+
+
+class PaginationCursorPage(models.Model):
+    """
+    Compressed ids of items of committed page of crawl, stored separately to keep checkpoint cheap
+    """
+    cursor = models.ForeignKey(PaginationCursor, related_name='pages')
+    ids = models.BinaryField()
+
+
+class RelationSnapshotManager(models.Manager):
+
+    def create_for(self, user, relation, ids, time=None):
+        """
+        Save snapshot of ids of related users `relation` of user
+        """
+        ids = id_array(ids)
+        return self.create(user=user, relation=relation, time=time or timezone.now(), count=len(ids),
+                           ids=diff.pack_ids(ids))
+
+    def get_at(self, user, relation, time):
+        """
+        Return the last snapshot of related users of user taken before or at `time`
+        """
+        return self.filter(user=user, relation=relation, time__lte=time).latest()
+
+
+class RelationSnapshot(models.Model):
+    """
+    Ids of followers or follows of user at the time of crawl, stored as compressed sorted array.
+    Enabled by setting SOCIAL_API_INSTAGRAM_SNAPSHOTS
+    """
+    class Meta:
+        unique_together = ('user', 'relation', 'time')
+        get_latest_by = 'time'
+
+    user = models.ForeignKey(User, related_name='relation_snapshots')
+    relation = models.CharField(max_length=20)
+    time = models.DateTimeField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+    ids = models.BinaryField()
+
+    objects = RelationSnapshotManager()
+
+    def __unicode__(self):
+        return '%s of %s at %s' % (self.relation, self.user_id, self.time)
+
+    def __contains__(self, id):
+        return diff.contains(self.get_ids(), id)
+
+    def get_ids(self):
+        """
+        Return sorted array of ids, it's unpacked once
+        """
+        if not hasattr(self, '_ids'):
+            self._ids = diff.unpack_ids(self.ids)
+        return self._ids
+
+    def union(self, other):
+        return diff.union(self.get_ids(), other.get_ids())
+
+    def intersection(self, other):
+        return diff.intersection(self.get_ids(), other.get_ids())
+
+    def delta(self, other):
+        """
+        Return tuple of arrays (added ids, removed ids) since other snapshot
+        """
+        return diff_ids(other.get_ids(), self.get_ids())
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import codecs
+import re
+
+import simplejson as json
+
+__all__ = ['JSONArrayStream']
+
+
+class JSONArrayStream(object):
+    """
+    Incremental decoder of JSON document from iterator of byte chunks.
+    Items of array `key` are yielded as soon as they are received, items should be objects or arrays.
+    The rest of the document with empty array is available in `document` after all items are yielded
+
+        stream = JSONArrayStream(chunks, 'nodes')
+        for node in stream:
+            ...
+        stream.document['page_info']
+    """
+    separator = re.compile(r'[\s,]*')
+
+    def __init__(self, chunks, key):
+        self.chunks = iter(chunks)
+        self.pattern = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.document = None
+
+    def read(self):
+        """
+        Return next decoded piece of text or None at the end of stream
+        """
+        for chunk in self.chunks:
+            text = self.text_decoder.decode(chunk)
+            if text:
+                return text
+        return None
+
+    def read_required(self):
+        text = self.read()
+        if text is None:
+            raise ValueError('Unexpected end of JSON document')
+        return text
+
+    def __iter__(self):
+        buffer = u''
+        # read the document until beginning of the array
+        while True:
+            match = self.pattern.search(buffer)
+            if match:
+                break
+            text = self.read()
+            if text is None:
+                # there is no array in the document, for example error response
+                self.document = json.loads(buffer)
+                return
+            buffer += text
+
+        head = buffer[:match.end()]
+        buffer = buffer[match.end():]
+        index = 0
+        while True:
+            index = self.separator.match(buffer, index).end()
+            if index == len(buffer):
+                buffer = self.read_required()
+                index = 0
+                continue
+            if buffer[index] == ']':
+                break
+            try:
+                item, index = self.decoder.raw_decode(buffer, index)
+            except ValueError:
+                # item is not received completely
+                buffer = buffer[index:] + self.read_required()
+                index = 0
+                continue
+            yield item
+
+        tail = [buffer[index:]]
+        text = self.read()
+        while text is not None:
+            tail += [text]
+            text = self.read()
+        self.document = json.loads(head + u''.join(tail))
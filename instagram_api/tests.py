@@ -1,13 +1,35 @@
 # -*- coding: utf-8 -*-
-from datetime import datetime
-
+from copy import deepcopy
+from datetime import datetime, timedelta
+from StringIO import StringIO
+import httplib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import mock
+import requests
+import simplejson as json
+from django.db import connection, connections, DatabaseError
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.conf import settings
 from django.utils import timezone
+from instagram import models as instagram_models
+from requests.cookies import extract_cookies_to_jar
+from requests.exceptions import ChunkedEncodingError, ConnectionError
 
 from .factories import UserFactory, LocationFactory
-from .models import Media, User, Tag, Location
-from .api import InstagramError
+from .models import Media, User, Tag, Location, Comment, PaginationCursor, RelationSnapshot, UserRecord
+from .api import InstagramError, InstagramClientError, InstagramApi, ResponseCache, TokenPool, RetryPolicy, \
+    CircuitBreaker, CircuitOpenError, MetricsRegistry, SingleFlight, api_call, api_call_async, get_call_key, \
+    iter_async, metrics
+from .decorators import fetch_all
+from .graphql import GraphQL, PageSize
+from .streaming import JSONArrayStream
+from .transport import CassetteTransport, CassetteError, PooledTransport, Response, cassette
 
 
 USER_ID = 237074561  # tnt_online
@@ -26,6 +48,28 @@ INSTAGRAM_USERNAME = 'atsepk'
 INSTAGRAM_PASSWORD = 'Jh6#dFwEHc'
 
 
+def user_resource(id, **kwargs):
+    kwargs.update(id=str(id), username='user%s' % id)
+    return instagram_models.User.object_from_dictionary(kwargs)
+
+
+def media_resource(id, user_id=USER_ID, created_time=1456000000, comments=(), tags=()):
+    return instagram_models.Media.object_from_dictionary({
+        'id': '%s_%s' % (id, user_id),
+        'type': 'image',
+        'user': {'id': str(user_id), 'username': 'user%s' % user_id},
+        'images': {'thumbnail': {'url': 'https://instagram.com/%s.jpg' % id, 'width': 150, 'height': 150}},
+        'likes': {'count': 0},
+        'comments': {'count': len(comments), 'data': list(comments)},
+        'created_time': str(created_time),
+        'location': None,
+        'caption': None,
+        'tags': list(tags),
+        'link': 'https://instagram.com/p/%s/' % id,
+        'filter': 'Normal',
+    })
+
+
 class InstagramApiTestCase(TestCase):
 
     _settings = None
@@ -34,9 +78,13 @@ class InstagramApiTestCase(TestCase):
         context = getattr(settings, 'SOCIAL_API_CALL_CONTEXT', {})
         self._settings = dict(context)
         context.update({'instagram': {'token': TOKEN}})
+        setattr(settings, 'SOCIAL_API_CALL_CONTEXT', context)
+        # circuits are shared by the process, failures of other tests shouldn't open them
+        InstagramApi.reset_circuit_breakers()
 
     def tearDown(self):
         setattr(settings, 'SOCIAL_API_CALL_CONTEXT', self._settings)
+        InstagramApi.reset_circuit_breakers()
 
 
 class UserTest(InstagramApiTestCase):
@@ -235,6 +283,212 @@ class UserTest(InstagramApiTestCase):
         userf.refresh()
         self.assertTrue(userf.is_private)
 
+    @mock.patch('instagram_api.models.UserManager.get')
+    def test_fetch_many_users(self, get):
+        def get_user(id, **kwargs):
+            if id == 0:
+                raise InstagramError(400, 'APINotFoundError', 'this user does not exist')
+            elif id == 4:
+                raise CircuitOpenError('Circuit of method user is open', status_code=503)
+            elif id == 5:
+                raise ConnectionError('Connection refused')
+            return User(id=id, username='user%d' % id, fetched=self.time)
+        get.side_effect = get_user
+        UserFactory(id=1, username='old')
+
+        with self.assertNumQueries(4):
+            # select of existing users, insert and update in transaction
+            users = User.remote.fetch_many([0, 1, 2, 3, 4, 5], workers=2)
+
+        self.assertEqual(get.call_count, 6)
+        self.assertItemsEqual(users.values_list('id', flat=True), [1, 2, 3])
+        self.assertEqual(User.objects.get(id=1).username, 'user1')
+
+    @mock.patch('instagram_api.models.api_call')
+    def test_fetch_followers_resume(self, api_call):
+        u = UserFactory(id=USER_ID)
+        error = InstagramError(500, 'InternalServerError', 'Internal server error')
+        api_call.side_effect = [([user_resource(i) for i in range(1, 4)], 'next1'), error]
+
+        with self.assertRaises(InstagramError):
+            u.fetch_followers()
+
+        api_call.reset_mock()
+        api_call.side_effect = [([user_resource(i) for i in range(4, 6)], None)]
+        followers = u.fetch_followers()
+
+        self.assertEqual(api_call.call_args_list[0], mock.call('user_followed_by', with_next_url='next1', user_id=USER_ID))
+        self.assertItemsEqual(followers.values_list('id', flat=True), range(1, 6))
+        self.assertEqual(PaginationCursor.objects.count(), 0)
+
+        api_call.reset_mock()
+        api_call.side_effect = [([user_resource(i) for i in range(1, 3)], None)]
+        followers = u.fetch_followers(resume=False)
+        self.assertEqual(api_call.call_args_list[0], mock.call('user_followed_by', USER_ID))
+        self.assertItemsEqual(followers.values_list('id', flat=True), [1, 2])
+
+    def test_set_m2m_history(self):
+        u = UserFactory(id=USER_ID)
+        for id in range(1, 6):
+            UserFactory(id=id)
+
+        User.remote.set_m2m_history(u, 'followers', [1, 2, 3, 3])
+        User.remote.set_m2m_history(u, 'followers', [2, 3, 4, 5])
+
+        self.assertItemsEqual(u.followers.all().values_list('id', flat=True), [2, 3, 4, 5])
+        version = u.followers.versions.latest()
+        self.assertEqual((version.count, version.added_count, version.removed_count), (4, 2, 1))
+        self.assertItemsEqual(version.removed(only_pk=True), [1])
+        self.assertItemsEqual(version.added(only_pk=True), [4, 5])
+        self.assertEqual(u.followers.versions.count(), 2)
+
+        # unchanged relation doesn't save version
+        User.remote.set_m2m_history(u, 'followers', [5, 4, 3, 2])
+        self.assertEqual(u.followers.versions.count(), 2)
+
+        User.remote.set_m2m_history(u, 'follows', [1, 2])
+        self.assertItemsEqual(u.follows.all().values_list('id', flat=True), [1, 2])
+        self.assertItemsEqual(User.objects.get(id=1).followers.all().values_list('id', flat=True), [USER_ID])
+
+    def test_set_m2m_history_atomic(self):
+        u = UserFactory(id=USER_ID)
+        for id in range(1, 4):
+            UserFactory(id=id)
+        User.remote.set_m2m_history(u, 'followers', [1, 2])
+
+        with mock.patch('instagram_api.models.ManyToManyHistoryVersion') as version:
+            version.objects.using.return_value.get_or_create.side_effect = DatabaseError('Failed')
+            with self.assertRaises(DatabaseError):
+                User.remote.set_m2m_history(u, 'followers', [2, 3])
+
+        self.assertItemsEqual(u.followers.all().values_list('id', flat=True), [1, 2])
+        self.assertEqual(u.followers.get_queryset_through().count(), 2)
+
+    @mock.patch('instagram_api.models.SNAPSHOTS', True)
+    @mock.patch('instagram_api.models.InstagramManager.api_call')
+    def test_relation_snapshots(self, api_call):
+        u = UserFactory(id=USER_ID)
+        api_call.side_effect = [([user_resource(i) for i in [1, 2, 3]], None),
+                                ([user_resource(i) for i in [2, 3, 4, 2 ** 40]], None)]
+        u.fetch_followers()
+        u.fetch_followers()
+
+        first, second = RelationSnapshot.objects.filter(user=u, relation='followers').order_by('time')
+        self.assertEqual(list(first.get_ids()), [1, 2, 3])
+        self.assertEqual(second.count, 4)
+        self.assertEqual(u.followers.versions.latest().time, second.time)
+        self.assertIn(2 ** 40, second)
+        self.assertNotIn(1, second)
+        self.assertEqual(list(second.union(first)), [1, 2, 3, 4, 2 ** 40])
+        self.assertEqual(list(second.intersection(first)), [2, 3])
+        self.assertEqual([list(ids) for ids in second.delta(first)], [[4, 2 ** 40], [1]])
+        self.assertEqual(RelationSnapshot.objects.get_at(u, 'followers', first.time), first)
+
+    def test_bulk_upsert(self):
+        UserFactory(id=1, username='user1', full_name='Old', followers_count=10)
+        UserFactory(id=2, username='user2', full_name='Same', followers_count=20)
+        fields = ('username', 'full_name', 'followers_count', 'fetched')
+
+        for supported in [True, False]:
+            with mock.patch('instagram_api.models.UserManager._upsert_supported', return_value=supported):
+                User.remote.bulk_create_from_instances([
+                    User(id=1, username='user1', full_name='New %s' % supported, fetched=self.time),
+                    User(id=2, username='user2', full_name='Same', followers_count=21),
+                    User(id=3, username='user3', full_name='Created'),
+                ], update_fields=fields)
+
+            self.assertEqual(User.objects.count(), 3)
+            self.assertEqual(User.objects.get(id=1).full_name, 'New %s' % supported)
+            self.assertEqual(User.objects.get(id=1).followers_count, 10)
+            self.assertEqual(User.objects.get(id=1).fetched, self.time)
+            self.assertEqual(User.objects.get(id=2).followers_count, 21)
+            self.assertEqual(User.objects.get(id=3).full_name, 'Created')
+
+    def test_bulk_upsert_records(self):
+        UserFactory(id=1, username='user1', full_name='Old', bio='Bio')
+        fields = ('username', 'full_name', 'fetched')
+
+        for supported in [True, False]:
+            records = [User.remote.parse_response_record(UserRecord, resource, {'fetched': self.time}) for resource in [
+                {'id': '1', 'username': 'user1', 'full_name': ' New %s ' % supported, 'is_verified': True},
+                {'id': '2', 'username': 'user2', 'full_name': 'a' * 90}]]
+            self.assertEqual(records[0].id, 1)
+            self.assertIsNone(records[0].bio)
+
+            with mock.patch('instagram_api.models.UserManager._upsert_supported', return_value=supported):
+                User.remote.bulk_upsert_records(records, update_fields=fields)
+
+            self.assertEqual(User.objects.count(), 2)
+            self.assertEqual(User.objects.get(id=1).full_name, 'New %s' % supported)
+            self.assertEqual(User.objects.get(id=1).bio, 'Bio')
+            self.assertEqual(User.objects.get(id=1).fetched, self.time)
+            self.assertEqual(User.objects.get(id=2).full_name, 'a' * 80)
+            self.assertEqual(User.objects.get(id=2).bio, '')
+
+    def test_bulk_upsert_unchanged(self):
+        fetched = self.time - timedelta(days=1)
+        UserFactory(id=1, username='user1', full_name='Same', fetched=fetched)
+        fields = ('username', 'full_name', 'fetched')
+
+        for supported in [True, False]:
+            records = [User.remote.parse_response_record(UserRecord, resource, {'fetched': self.time}) for resource in [
+                {'id': '1', 'username': 'user1', 'full_name': 'Same'},
+                {'id': '2', 'username': 'user2', 'full_name': 'Old'},
+                {'id': '2', 'username': 'user2', 'full_name': 'New %s' % supported}]]
+
+            with mock.patch('instagram_api.models.UserManager._upsert_supported', return_value=supported):
+                User.remote.bulk_upsert_records(records, update_fields=fields)
+
+            # time of fetching alone doesn't make the row changed
+            self.assertEqual(User.objects.get(id=1).fetched, fetched)
+            self.assertEqual(User.objects.get(id=2).full_name, 'New %s' % supported)
+
+    def test_bulk_create_existing(self):
+        User.objects.bulk_create([User(id=id, username='user%d' % id) for id in range(0, 1200, 2)])
+
+        self.assertEqual(User.remote.get_existing_values('id', range(1200)), set(range(0, 1200, 2)))
+
+        User.remote.bulk_create_from_instances([User(id=id, username='user%d' % id) for id in [1, 2, 3, 3]])
+        self.assertEqual(User.objects.count(), 602)
+
+    def test_sanitize_many(self):
+        users = [User(id=1, username='user1', full_name=u'a' * 90, bio=u'bad \ud83c'),
+                 User(id=2, username='user2', full_name=u'a' * 79 + u'\ud83cbc', bio=u'good \u2728'),
+                 User(id=3, username='user3', full_name=u'name', bio=u'bad \ud83c')]
+        User.sanitize_many(users)
+
+        self.assertEqual(users[0].full_name, u'a' * 80)
+        # broken symbol is dropped from string of instance with cut values, otherwise string is cleaned
+        self.assertEqual(users[0].bio, u'bad ')
+        self.assertEqual(users[1].full_name, u'a' * 79)
+        self.assertEqual(users[1].bio, u'good \u2728')
+        self.assertEqual(users[2].bio, u'')
+        self.assertEqual(User.get_sanitize_plan()[:2], [('username', 30), ('full_name', 80)])
+
+        media = Media(caption=None)
+        media._sanitize()
+        self.assertEqual(media.caption, '')
+
+    def test_parse_plan(self):
+        self.assertIs(User.get_parse_plan(), User.get_parse_plan())
+        self.assertNotIn('likes_users', User.get_parse_plan())
+
+        media = Media()
+        media._response = {
+            'remote_id': '1_2', 'user': {'id': 2, 'username': 'user2'}, 'caption': ' text ', 'likes_count': '3',
+            'comments': [{'id': 5, 'text': 'comment', 'created_at': '1'}], 'likes_users': [{'id': 4, 'username': 'user4'}],
+            'unknown': 'value', 'location': None}
+        # parse fields without conversions of Media.parse
+        super(Media, media).parse()
+
+        self.assertEqual(media.caption, 'text')
+        self.assertEqual(media.likes_count, 3)
+        self.assertEqual(media.user.username, 'user2')
+        self.assertEqual(media._relations_pre_save, [('user', media.user)])
+        self.assertEqual(media._relations_post_save['fk']['comments'][0].text, 'comment')
+        self.assertEqual(media._relations_post_save['m2m']['likes_users'][0].username, 'user4')
+        self.assertIsNone(media.location)
+
     def test_unexisted_user(self):
         with self.assertRaises(InstagramError):
             User.remote.get(0)
@@ -330,6 +584,162 @@ class MediaTest(InstagramApiTestCase):
         self.assertEqual(media.count(), 53)  # not 50 for some strange reason
         self.assertEqual(media.count(), u.media_feed.count())
 
+    @mock.patch('instagram_api.models.api_call')
+    def test_fetch_user_media_pages(self, api_call):
+        u = UserFactory(id=USER_ID)
+        api_call.side_effect = [
+            ([media_resource(i, created_time=1456000000 - i) for i in range(0, 3)], 'next1'),
+            ([media_resource(i, created_time=1456000000 - i) for i in range(3, 6)], 'next2'),
+            ([media_resource(i, created_time=1456000000 - i) for i in range(6, 9)], None),
+        ]
+
+        media = u.fetch_media(count=5)
+
+        self.assertEqual(media.count(), 5)
+        self.assertEqual(api_call.call_args_list[1], mock.call('user_recent_media', with_next_url='next1'))
+        self.assertEqual(media.order_by('-created_time')[0].remote_id, '0_%s' % USER_ID)
+
+    @mock.patch('instagram_api.models.api_call')
+    def test_fetch_user_media_resume(self, api_call):
+        u = UserFactory(id=USER_ID)
+        error = InstagramError(500, 'InternalServerError', 'Internal server error')
+        api_call.side_effect = [([media_resource(i) for i in range(0, 3)], 'next1'), error]
+
+        with self.assertRaises(InstagramError):
+            u.fetch_media()
+
+        cursor = PaginationCursor.objects.get(manager='MediaManager', method='user_recent_media', target=USER_ID)
+        self.assertEqual((cursor.cursor, cursor.count), ('next1', 3))
+
+        api_call.reset_mock()
+        api_call.side_effect = [([media_resource(i) for i in range(3, 6)], None)]
+        media = u.fetch_media()
+
+        self.assertEqual(media.count(), 6)
+        self.assertEqual(api_call.call_args_list[0], mock.call('user_recent_media', with_next_url='next1'))
+        self.assertEqual(PaginationCursor.objects.count(), 0)
+
+    @mock.patch('instagram_api.models.api_call')
+    def test_fetch_user_media_resume_params(self, api_call):
+        u = UserFactory(id=USER_ID)
+        error = InstagramError(500, 'InternalServerError', 'Internal server error')
+        next_url = 'https://api.instagram.com/v1/users/%s/media/recent?access_token=token&max_id=1' % USER_ID
+        api_call.side_effect = [([media_resource(i) for i in range(0, 3)], next_url), error]
+
+        with self.assertRaises(InstagramError):
+            u.fetch_media()
+
+        cursor = PaginationCursor.objects.get(manager='MediaManager', method='user_recent_media', target=USER_ID)
+        self.assertEqual(cursor.cursor, 'https://api.instagram.com/v1/users/%s/media/recent?max_id=1' % USER_ID)
+
+        # crawl with other arguments starts from the first page
+        api_call.reset_mock()
+        api_call.side_effect = [([media_resource(i) for i in range(0, 3)], None)]
+        u.fetch_media(count=3)
+
+        self.assertEqual(api_call.call_args_list[0], mock.call('user_recent_media', user_id=USER_ID, count=3))
+        self.assertEqual(PaginationCursor.objects.count(), 0)
+
+    def test_sign_next_url(self):
+        api = InstagramApi()
+        api.api = api.get_api('token')
+        url = 'https://api.instagram.com/v1/users/%s/media/recent?max_id=1' % USER_ID
+
+        self.assertEqual(api.sign_next_url(url), url + '&access_token=token')
+        self.assertEqual(api.sign_next_url(url + '&access_token=other'), url + '&access_token=other')
+
+    @mock.patch('instagram_api.models.api_call')
+    def test_fetch_user_media_stream(self, api_call):
+        u = UserFactory(id=USER_ID)
+        pages = {
+            None: ([media_resource(i) for i in range(0, 3)], 'next1'),
+            'next1': ([media_resource(i) for i in range(3, 6)], 'next2'),
+            'next2': ([media_resource(i) for i in range(6, 8)], None),
+        }
+        # pages are prefetched in the background thread
+        api_call.side_effect = lambda method, with_next_url=None, **kwargs: deepcopy(pages[with_next_url])
+
+        progress = u.fetch_media(stream=True)
+        self.assertEqual(api_call.call_count, 0)
+
+        page = next(progress)
+        self.assertEqual((page.page, len(page.instances), page.count, page.next_url), (1, 3, 3, 'next1'))
+        self.assertEqual(Media.objects.count(), 3)
+        progress.close()
+
+        media = u.fetch_media()
+        self.assertEqual(media.count(), 8)
+        self.assertIn(mock.call('user_recent_media', with_next_url='next2'), api_call.call_args_list)
+
+    def test_get_or_create_many(self):
+        def save_page(ids):
+            instances = [Media.remote.parse_response_object(media_resource(id)) for id in ids]
+            with CaptureQueriesContext(connection) as queries:
+                media = Media.remote.get_or_create_many(instances)
+            return media, len(queries)
+
+        media, queries = save_page(range(0, 3))
+        self.assertEqual(media.count(), 3)
+        self.assertEqual(save_page(range(0, 10))[1], queries)
+
+        Media.objects.filter(remote_id='1_%s' % USER_ID).update(caption='old')
+        media, queries = save_page([1, 1, 20])
+        self.assertEqual(media.count(), 2)
+        self.assertEqual(Media.objects.count(), 11)
+        self.assertEqual(Media.objects.get(remote_id='1_%s' % USER_ID).caption, '')
+        self.assertEqual(User.objects.get(id=USER_ID).username, 'user%s' % USER_ID)
+
+        with mock.patch('instagram_api.models.InstagramManager._upsert_supported', return_value=False):
+            Media.objects.filter(remote_id='1_%s' % USER_ID).update(caption='old')
+            media, queries = save_page([1, 30])
+        self.assertEqual(media.count(), 2)
+        self.assertEqual(Media.objects.count(), 12)
+        self.assertEqual(Media.objects.get(remote_id='1_%s' % USER_ID).caption, '')
+
+    def test_save_media_comments(self):
+        def comment(id, user_id):
+            return {'id': str(id), 'text': 'comment %d' % id, 'created_time': '1456000000',
+                    'from': {'id': str(user_id), 'username': 'user%d' % user_id, 'full_name': ''}}
+
+        def save_media(id, comments):
+            instance = Media.remote.parse_response_object(media_resource(id, comments=comments))
+            with CaptureQueriesContext(connection) as queries:
+                instance = Media.remote.get_or_create_from_instance(instance)
+            return instance, len(queries)
+
+        UserFactory(id=USER_ID)
+        media, queries = save_media(1, [comment(1, 1), comment(2, 2)])
+        self.assertEqual(save_media(2, [comment(i, i % 5 + 1) for i in range(3, 30)])[1], queries)
+
+        self.assertEqual(media.comments.count(), 2)
+        self.assertEqual(Comment.objects.count(), 29)
+        self.assertEqual(User.objects.filter(comments__isnull=False).distinct().count(), 5)
+        self.assertEqual(Comment.objects.get(id=3).owner_id, USER_ID)
+
+    def test_bulk_add_m2m(self):
+        UserFactory(id=USER_ID)
+        instances = [Media.remote.parse_response_object(media_resource(id, tags=['tag1', 'tag%d' % id]))
+                     for id in range(2, 5)]
+        media = Media.remote.get_or_create_many(instances)
+
+        self.assertEqual(Tag.objects.count(), 4)
+        self.assertItemsEqual(Media.objects.get(remote_id='2_%s' % USER_ID).tags.values_list('name', flat=True),
+                              ['tag1', 'tag2'])
+        self.assertEqual(Tag.objects.get(name='tag1').media_feed.count(), 3)
+
+        users = [UserFactory(id=id) for id in range(1, 4)]
+        for vendor in ['sqlite', 'mysql']:
+            with mock.patch.object(connections['default'], 'vendor', vendor):
+                Media.remote.bulk_add_m2m('likes_users', [(media[0].pk, user.pk) for user in users])
+                Media.remote.bulk_add_m2m('likes_users', [(media[0].pk, users[0].pk), (media[1].pk, users[0].pk)])
+                Media.remote.bulk_add_m2m('tags', [(media[0].pk, Tag.objects.get(name='tag1').pk)])
+
+            self.assertItemsEqual(media[0].likes_users.all(), users)
+            self.assertEqual(media[0].likes_users.get_queryset_through().exclude(time_from=None).count(), 3)
+            self.assertEqual(users[0].likes_media.count(), 2)
+            self.assertEqual(media[0].tags.count(), 2)
+            media[0].likes_users.get_queryset_through().delete()
+
     def test_fetch_media_with_location(self):
 
         media = Media.remote.fetch('1105137931436928268_1692711770')
@@ -383,6 +793,20 @@ class TagTest(InstagramApiTestCase):
         self.assertGreater(media.count(), 0)
         self.assertEqual(media.count(), t.media_feed.count())
 
+    @mock.patch('instagram_api.models.api_call')
+    def test_fetch_tag_media_unicode(self, api_call):
+        UserFactory(id=USER_ID)
+        tag = Tag.objects.create(name=u'тег')
+        error = InstagramError(500, 'InternalServerError', 'Internal server error')
+        api_call.side_effect = [([media_resource(i) for i in range(0, 3)], 'next1'), error]
+
+        with self.assertRaises(InstagramError):
+            tag.fetch_media()
+
+        cursor = PaginationCursor.objects.get(manager='MediaManager', method='tag_recent_media', target=u'тег')
+        self.assertEqual((cursor.cursor, cursor.count), ('next1', 3))
+        self.assertEqual(tag.media_feed.count(), 3)
+
 
 class LocationTest(InstagramApiTestCase):
     def test_fetch_location(self):
@@ -410,6 +834,598 @@ class LocationTest(InstagramApiTestCase):
         self.assertEqual(media.count(), location.media_count)
 
 
+class TokenPoolTest(TestCase):
+
+    @mock.patch('instagram_api.api.time', return_value=1000.0)
+    def test_acquire_token_with_most_budget(self, time):
+        pool = TokenPool(limit=2, window=10, cooldown=60)
+
+        self.assertEqual(pool.acquire(['a', 'b']), ('b', 0))
+        self.assertEqual(pool.acquire(['a', 'b']), ('a', 0))
+        self.assertEqual(pool.acquire(['a', 'b']), ('b', 0))
+        self.assertEqual(pool.budget('a'), 1)
+        self.assertEqual(pool.budget('b'), 0)
+
+    @mock.patch('instagram_api.api.time')
+    def test_wait_until_earliest_token_refills(self, time):
+        pool = TokenPool(limit=1, window=10, cooldown=60)
+
+        time.return_value = 1000.0
+        pool.acquire(['a'])
+        time.return_value = 1004.0
+        pool.acquire(['b'])
+
+        self.assertEqual(pool.acquire(['a', 'b']), (None, 6))
+
+        time.return_value = 1010.0
+        self.assertEqual(pool.acquire(['a', 'b']), ('a', 0))
+
+    @mock.patch('instagram_api.api.time')
+    def test_exhaust_token(self, time):
+        pool = TokenPool(limit=10, window=100, cooldown=60)
+
+        time.return_value = 1000.0
+        pool.exhaust('a')
+        self.assertEqual(pool.budget('a'), 0)
+        self.assertEqual(pool.acquire(['a']), (None, 60))
+
+        pool.acquire(['b'])
+        time.return_value = 1050.0
+        pool.exhaust('b')
+        self.assertEqual(pool.acquire(['a', 'b']), (None, 10))
+
+
+class ResponseCacheTest(TestCase):
+
+    @mock.patch('instagram_api.api.time', return_value=1000.0)
+    def test_lru_eviction(self, time):
+        cache = ResponseCache(ttl={'user': 60}, size=2)
+
+        cache.set('user', (1,), {}, {'id': 1})
+        cache.set('user', (2,), {}, {'id': 2})
+        self.assertEqual(cache.get('user', (1,), {}), (True, {'id': 1}))
+        cache.set('user', (3,), {}, {'id': 3})
+
+        self.assertEqual(cache.get('user', (2,), {}), (False, None))
+        self.assertEqual(cache.get('user', (1,), {}), (True, {'id': 1}))
+        self.assertEqual(cache.get('user', (3,), {}), (True, {'id': 3}))
+        self.assertEqual(cache.stats, {'hits': 3, 'misses': 1, 'evictions': 1, 'size': 2})
+
+    @mock.patch('instagram_api.api.time')
+    def test_ttl_and_uncached_methods(self, time):
+        cache = ResponseCache(ttl={'user': 60})
+
+        time.return_value = 1000.0
+        cache.set('user', (1,), {}, {'id': 1})
+        cache.set('media', (1,), {}, {'id': 1})
+        self.assertEqual(cache.get('media', (1,), {}), (False, None))
+
+        time.return_value = 1059.0
+        self.assertEqual(cache.get('user', (1,), {}), (True, {'id': 1}))
+        time.return_value = 1060.0
+        self.assertEqual(cache.get('user', (1,), {}), (False, None))
+        self.assertEqual(cache.stats['misses'], 1)
+
+    def test_response_is_copied(self):
+        cache = ResponseCache(ttl={'user': 60})
+        response = {'id': 1}
+
+        cache.set('user', (1,), {}, response)
+        response['id'] = 2
+        cache.get('user', (1,), {})[1]['id'] = 3
+
+        self.assertEqual(cache.get('user', (1,), {})[1], {'id': 1})
+
+    def test_shared_backend(self):
+        cache = ResponseCache(ttl={'user': 60}, size=1, backend='default')
+
+        cache.set('user', (1,), {}, {'id': 1})
+        cache.set('user', (2,), {}, {'id': 2})
+
+        self.assertEqual(cache.get('user', (1,), {}), (True, {'id': 1}))
+        self.assertEqual(cache.stats, {'hits': 1, 'misses': 0, 'evictions': 2, 'size': 1})
+
+        # promoted response keeps expiration time of the shared one
+        with mock.patch('instagram_api.api.time', return_value=time.time() + 61):
+            self.assertEqual(cache.get('user', (1,), {}), (False, None))
+        cache.get_backend().clear()
+
+    def test_context_of_call(self):
+        cache = ResponseCache(ttl={'user': 60})
+        with self.settings(SOCIAL_API_CALL_CONTEXT={'instagram': {'token': 'token1'}}):
+            cache.set('user', (1,), {}, {'id': 1, 'is_private': False})
+            self.assertEqual(cache.get('user', (1,), {}), (True, {'id': 1, 'is_private': False}))
+        with self.settings(SOCIAL_API_CALL_CONTEXT={'instagram': {'token': 'token2'}}):
+            self.assertEqual(cache.get('user', (1,), {}), (False, None))
+        with self.settings(SOCIAL_API_CALL_CONTEXT={'instagram': {'use_client_id': True}}):
+            self.assertEqual(cache.get('user', (1,), {}), (False, None))
+
+
+class RetryPolicyTest(InstagramApiTestCase):
+
+    def test_backoff_delay(self):
+        policy = RetryPolicy(base=1, cap=10, max_attempts=3)
+
+        for attempt, max_delay in enumerate([1, 2, 4, 8, 10, 10]):
+            for i in range(20):
+                self.assertTrue(0 <= policy.get_delay(attempt) <= max_delay)
+        self.assertTrue(policy.can_retry(2))
+        self.assertFalse(policy.can_retry(3))
+
+    @mock.patch('instagram_api.api.time')
+    def test_circuit_breaker(self, time):
+        breaker = CircuitBreaker(threshold=2, timeout=60)
+
+        time.return_value = 1000.0
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+        # only one probe in half-open state, failed probe opens circuit again
+        time.return_value = 1060.0
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+
+        time.return_value = 1120.0
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+
+    @mock.patch('instagram_api.api.sleep')
+    @mock.patch('instagram.client.InstagramAPI.user')
+    def test_server_errors_fail_fast(self, user, sleep):
+        user.side_effect = InstagramClientError('Unable to parse response, not valid JSON.', status_code='502')
+
+        with mock.patch.object(InstagramApi, 'retry_policy', RetryPolicy(base=1, cap=10, max_attempts=3)):
+            with self.assertRaises(InstagramClientError):
+                api_call('user', USER_ID)
+            self.assertEqual(user.call_count, 4)
+            self.assertEqual(sleep.call_count, 3)
+
+            # circuit opens after 5th failure in a row and retry fails fast
+            with self.assertRaises(CircuitOpenError):
+                api_call('user', USER_ID_2)
+            self.assertEqual(user.call_count, 5)
+            with self.assertRaises(CircuitOpenError):
+                api_call('user', USER_ID_2)
+            self.assertEqual(user.call_count, 5)
+
+    @mock.patch('instagram_api.api.sleep')
+    @mock.patch('instagram.client.InstagramAPI.user')
+    def test_network_errors_keep_circuit_closed(self, user, sleep):
+        user.side_effect = ConnectionError('Connection refused')
+
+        with mock.patch.object(InstagramApi, 'retry_policy', RetryPolicy(base=1, cap=10, max_attempts=5)):
+            with self.assertRaises(ConnectionError):
+                api_call('user', USER_ID)
+        self.assertEqual(user.call_count, 6)
+        self.assertEqual(InstagramApi().get_circuit_breaker('user').state, 'closed')
+
+    @mock.patch('instagram.client.InstagramAPI.user')
+    def test_rate_limit_keeps_circuit_closed(self, user):
+        error = InstagramError(503, 'Rate limited', 'Your client is making too many request per second')
+        user.side_effect = [error] * 6 + [user_resource(USER_ID)]
+
+        with mock.patch.object(InstagramApi, 'token_pool') as token_pool:
+            token_pool.acquire.side_effect = lambda tokens: (tokens[0], 0)
+            self.assertEqual(api_call('user', USER_ID).id, str(USER_ID))
+        self.assertEqual(token_pool.exhaust.call_count, 6)
+        self.assertEqual(InstagramApi().get_circuit_breaker('user').state, 'closed')
+
+
+class MetricsTest(InstagramApiTestCase):
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        # registry and circuits of the process are left by other tests
+        metrics.reset()
+
+    def tearDown(self):
+        super(MetricsTest, self).tearDown()
+        metrics.reset()
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.observe('user', 0.2, 200, TOKEN)
+        registry.observe('user', 3, 502, TOKEN)
+        registry.inc_handler('handle_error_code_502')
+        registry.add_sleep('server_error', 1.5)
+
+        text = registry.render()
+
+        self.assertIn('# TYPE instagram_api_request_duration_seconds histogram', text)
+        self.assertIn('instagram_api_request_duration_seconds_bucket{le="0.1",method="user"} 0', text)
+        self.assertIn('instagram_api_request_duration_seconds_bucket{le="0.25",method="user"} 1', text)
+        self.assertIn('instagram_api_request_duration_seconds_bucket{le="+Inf",method="user"} 2', text)
+        self.assertIn('instagram_api_request_duration_seconds_sum{method="user"} 3.2', text)
+        self.assertIn('instagram_api_responses_total{code="502",method="user"} 1', text)
+        self.assertIn('instagram_api_token_requests_total{token="1687258424"} 2', text)
+        self.assertIn('instagram_api_error_handlers_total{handler="handle_error_code_502"} 1', text)
+        self.assertIn('instagram_api_sleep_seconds_total{reason="server_error"} 1.5', text)
+        self.assertNotIn(TOKEN, text)
+
+    @mock.patch('instagram_api.api.sleep')
+    @mock.patch('instagram.client.InstagramAPI.user')
+    def test_api_call(self, user, sleep):
+        user.side_effect = [InstagramClientError('Unable to parse response, not valid JSON.', status_code='500'),
+                            mock.Mock()]
+
+        api_call('user', USER_ID)
+
+        self.assertEqual(metrics.latency_count['user'], 2)
+        self.assertEqual(metrics.responses[('user', '500')], 1)
+        self.assertEqual(metrics.responses[('user', '200')], 1)
+        self.assertEqual(metrics.handlers['handle_error_code_500'], 1)
+        self.assertEqual(metrics.retries['user'], 1)
+        self.assertEqual(metrics.sleeps['server_error'], sleep.call_args[0][0])
+
+
+class SingleFlightTest(TestCase):
+
+    def wait_waiters(self, singleflight, key, count, timeout=5):
+        """
+        Wait until `count` callers join the first call with `key`
+        """
+        deadline = time.time() + timeout
+        while not singleflight.calls or singleflight.calls[key].waiters < count:
+            if time.time() > deadline:
+                self.fail('Calls with key %s were not coalesced in %s sec' % (key, timeout))
+            time.sleep(0.01)
+
+    def test_coalesce_calls(self):
+        singleflight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            release.wait()
+            return {'id': 1}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(singleflight.do('user.1', func)))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        try:
+            self.wait_waiters(singleflight, 'user.1', 4)
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'id': 1}] * 5)
+        self.assertEqual(len(set([id(result) for result in results])), 5)
+        self.assertEqual(singleflight.calls, {})
+
+    def test_share_error(self):
+        singleflight = SingleFlight()
+        release = threading.Event()
+
+        def func():
+            release.wait()
+            raise InstagramError(400, 'APINotFoundError', 'this user does not exist')
+
+        errors = []
+
+        def worker():
+            try:
+                singleflight.do('user.1', func)
+            except InstagramError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        try:
+            self.wait_waiters(singleflight, 'user.1', 2)
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(errors[0].error_type, 'APINotFoundError')
+
+    def test_key_of_context(self):
+        with self.settings(SOCIAL_API_CALL_CONTEXT={'instagram': {'token': 'token1'}}):
+            key = get_call_key('user', (1,), {})
+            self.assertEqual(key, get_call_key('user', (1,), {}))
+        with self.settings(SOCIAL_API_CALL_CONTEXT={'instagram': {'token': 'token2'}}):
+            self.assertNotEqual(key, get_call_key('user', (1,), {}))
+        with self.settings(SOCIAL_API_CALL_CONTEXT={'instagram': {'use_client_id': True}}):
+            self.assertNotEqual(key, get_call_key('user', (1,), {}))
+
+
+class AsyncTest(InstagramApiTestCase):
+
+    @mock.patch('instagram.client.InstagramAPI.user')
+    def test_api_call_async(self, user):
+        user.side_effect = lambda id: {'id': id}
+
+        results = [api_call_async('user', id) for id in range(20)]
+
+        self.assertEqual([result.get(timeout=5) for result in results], [{'id': id} for id in range(20)])
+
+    @mock.patch('instagram_api.api.connection')
+    @mock.patch('instagram.client.InstagramAPI.user')
+    def test_api_call_async_connection(self, user, connection):
+        user.side_effect = InstagramError(400, 'APINotFoundError', 'this user does not exist')
+
+        with self.assertRaises(InstagramError):
+            api_call_async('user', USER_ID).get(timeout=5)
+        # DB connection of the thread of the pool is closed after the call
+        self.assertEqual(connection.close.call_count, 1)
+
+    @mock.patch('instagram_api.models.UserManager.get')
+    def test_get_async(self, get):
+        get.side_effect = lambda id, **kwargs: User(id=id)
+
+        self.assertEqual(User.remote.get_async(USER_ID).get(timeout=5).id, USER_ID)
+
+    def test_iter_async(self):
+        def pages():
+            for i in range(3):
+                yield [i]
+            raise InstagramError(400, 'APINotFoundError', 'this user does not exist')
+
+        closed = threading.Event()
+        with mock.patch('instagram_api.api.connection') as connection:
+            connection.close.side_effect = closed.set
+            iterator = iter_async(pages(), 2)
+            self.assertEqual([iterator.next() for i in range(3)], [[0], [1], [2]])
+            with self.assertRaises(InstagramError):
+                iterator.next()
+            # DB connection of the background thread is closed
+            self.assertTrue(closed.wait(5))
+
+    def test_iter_async_stop(self):
+        produced = []
+
+        def pages():
+            for i in range(100):
+                produced.append(i)
+                yield [i]
+
+        for page in iter_async(pages()):
+            break
+        time.sleep(0.3)
+
+        self.assertLess(len(produced), 5)
+
+
+class TransportTest(TestCase):
+
+    def test_cookies_not_kept(self):
+        transport = PooledTransport()
+        request = requests.Request('GET', 'https://www.instagram.com/tnt_online/').prepare()
+        response = mock.Mock()
+        response._original_response.msg = httplib.HTTPMessage(
+            StringIO('Set-Cookie: sessionid=1; Domain=.instagram.com; Path=/\r\n\r\n'))
+
+        extract_cookies_to_jar(transport.session.cookies, request, response)
+
+        self.assertEqual(len(transport.session.cookies), 0)
+
+
+class CassetteTest(InstagramApiTestCase):
+
+    def setUp(self):
+        super(CassetteTest, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'cassette.json.gz')
+
+    def tearDown(self):
+        super(CassetteTest, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def record(self, *contents):
+        transport = mock.Mock()
+        transport.request.side_effect = [(Response(200, {'Set-Cookie': 'sessionid=1'}), content)
+                                         for content in contents]
+        recorder = CassetteTransport(self.path, mode='record', transport=transport)
+        for content in contents:
+            recorder.request('https://api.instagram.com/v1/users/%d.json?access_token=%s' % (USER_ID, TOKEN))
+        recorder.close()
+
+    def test_replay(self):
+        next_url = 'https:\\/\\/api.instagram.com\\/v1\\/users\\/%d\\/media\\/recent?%s' % (USER_ID, '%s')
+        self.record('{"id": 1, "next_url": "%s"}' % next_url % ('access_token=%s&max_id=1' % TOKEN), '{"id": 2}')
+        player = CassetteTransport(self.path)
+        url = 'https://api.instagram.com/v1/users/%d.json?access_token=another' % USER_ID
+
+        for content in ['{"id": 1, "next_url": "%s"}' % next_url % 'max_id=1', '{"id": 2}', '{"id": 2}']:
+            response, body = player.request(url)
+            self.assertEqual(response['status'], '200')
+            self.assertEqual(body, content)
+        self.assertNotIn('set-cookie', response)
+        self.assertNotIn(TOKEN, str(player.interactions))
+
+        with self.assertRaises(CassetteError):
+            player.request('https://api.instagram.com/v1/users/%d.json' % USER_ID_2)
+
+    def test_replay_api_call(self):
+        self.record('{"meta": {"code": 200}, "data": {"id": "%d", "username": "tnt_online"}}' % USER_ID)
+
+        with cassette(self.path):
+            user = User.remote.fetch(USER_ID)
+
+        self.assertEqual(user.username, 'tnt_online')
+
+
+class GraphQLTest(InstagramApiTestCase):
+
+    def setUp(self):
+        super(GraphQLTest, self).setUp()
+        # profile page with csrf token and pages of graphql responses set by tests
+        self.sleep = self.patch('instagram_api.graphql.time.sleep')
+        auth_request = self.patch('instagram_api.graphql.InstagramAuthRequest')
+        auth_request.return_value.get_csrf_token_from_content.return_value = 'token'
+        self.transport = self.patch('instagram_api.graphql.get_transport').return_value
+        self.transport.request.return_value = (Response(200, {}), '<html/>')
+
+    def patch(self, target):
+        patcher = mock.patch(target)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def graphql_page(self, ids, end_cursor, has_next_page):
+        nodes = [{'id': str(id), 'username': 'user%d' % id, 'full_name': '', 'profile_pic_url': ''} for id in ids]
+        return json.dumps({'status': 'ok', 'followed_by': {
+            'count': 5, 'page_info': {'end_cursor': end_cursor, 'has_next_page': has_next_page}, 'nodes': nodes}})
+
+    def test_page_size(self):
+        page_size = PageSize(minimum=100, maximum=1000, latency=5)
+        self.assertEqual(page_size.limit, 1000)
+
+        page_size.record_failure()
+        page_size.record_success(10)
+        self.assertEqual(page_size.limit, 250)
+        page_size.record_success(1)
+        self.assertEqual(page_size.limit, 350)
+        for i in range(10):
+            page_size.record_failure()
+        self.assertEqual(page_size.limit, 100)
+
+    def test_related_users(self):
+        self.transport.stream.side_effect = [(Response(200, {}), [content]) for content in [
+            json.dumps({'status': 'fail', 'message': 'Sorry, too many requests. Please try again later.'}),
+            self.graphql_page([1, 2, 3], 'cursor1', True),
+            self.graphql_page([4, 5], 'cursor2', False),
+        ]]
+
+        pages = list(GraphQL().related_users('followed_by', User(id=USER_ID, username='user')))
+
+        self.assertEqual([(len(nodes), end_cursor) for nodes, end_cursor in pages], [(3, 'cursor1'), (2, None)])
+        self.assertEqual(self.sleep.call_count, 1)
+        queries = [call[1]['body']['q'] for call in self.transport.stream.call_args_list]
+        self.assertIn('followed_by.first(500)', queries[1])
+        self.assertIn('followed_by.after(cursor1, 600)', queries[2])
+
+    def test_related_users_connection_error(self):
+        self.transport.stream.side_effect = [
+            ConnectionError('Connection reset by peer'),
+            (Response(200, {}), [self.graphql_page([1, 2, 3], 'cursor1', False)]),
+        ]
+
+        pages = list(GraphQL().related_users('followed_by', User(id=USER_ID, username='user')))
+
+        self.assertEqual([(len(nodes), end_cursor) for nodes, end_cursor in pages], [(3, None)])
+        self.assertEqual(self.sleep.call_count, 1)
+        queries = [call[1]['body']['q'] for call in self.transport.stream.call_args_list]
+        self.assertIn('followed_by.first(500)', queries[1])
+
+    def test_related_users_batches_read_error(self):
+        content = self.graphql_page([1, 2, 3, 4, 5], 'cursor1', False)
+
+        def broken_chunks():
+            yield content[:content.index('"4"')]
+            raise ChunkedEncodingError('Connection broken: IncompleteRead')
+
+        self.transport.stream.side_effect = [(Response(200, {}), broken_chunks()), (Response(200, {}), [content])]
+
+        batches = list(GraphQL().related_users_batches('followed_by', User(id=USER_ID, username='user'), size=2))
+
+        # the page is requested again, nodes handed downstream before the error are skipped
+        self.assertEqual([[node['id'] for node in nodes] for nodes, page_info in batches],
+                         [['1', '2'], ['3', '4'], ['5']])
+        self.assertEqual(self.sleep.call_count, 1)
+        queries = [call[1]['body']['q'] for call in self.transport.stream.call_args_list]
+        self.assertIn('followed_by.first(500)', queries[1])
+
+    def test_related_users_batches(self):
+        content = self.graphql_page([1, 2, 3, 4, 5], 'cursor1', False)
+        self.transport.stream.return_value = (Response(200, {}), [content])
+
+        batches = list(GraphQL().related_users_batches('followed_by', User(id=USER_ID, username='user'), size=2))
+
+        self.assertEqual([[node['id'] for node in nodes] for nodes, page_info in batches],
+                         [['1', '2'], ['3', '4'], ['5']])
+        self.assertEqual([page_info for nodes, page_info in batches],
+                         [None, None, {'end_cursor': 'cursor1', 'has_next_page': False}])
+
+    def test_json_array_stream(self):
+        content = json.dumps({'status': 'ok', 'followed_by': {
+            'nodes': [{'id': str(i), 'full_name': u'Имя %d' % i} for i in range(10)],
+            'page_info': {'end_cursor': 'cursor1', 'has_next_page': True}}}, ensure_ascii=False).encode('utf-8')
+
+        for chunk_size in [1, 7, len(content)]:
+            stream = JSONArrayStream([content[i:i + chunk_size] for i in range(0, len(content), chunk_size)], 'nodes')
+            nodes = list(stream)
+            self.assertEqual([node['full_name'] for node in nodes], [u'Имя %d' % i for i in range(10)])
+            self.assertEqual(stream.document['followed_by']['nodes'], [])
+            self.assertEqual(stream.document['followed_by']['page_info']['end_cursor'], 'cursor1')
+
+        stream = JSONArrayStream(['{"status": "fail", ', '"message": "Sorry"}'], 'nodes')
+        self.assertEqual(list(stream), [])
+        self.assertEqual(stream.document['status'], 'fail')
+
+    @mock.patch('instagram_api.models.UserManager.create_related_users')
+    def test_fetch_followers_many(self, create_related_users):
+        def crawl(method, user, **kwargs):
+            if user.pk == 2:
+                raise InstagramError(500, 'InternalServerError', 'Internal server error')
+            return [user.pk]
+        create_related_users.side_effect = crawl
+
+        result = User.remote.fetch_followers_many([User(id=id) for id in range(1, 5)], workers=2, source='graphql')
+
+        self.assertEqual(result, {1: [1], 3: [3], 4: [4]})
+        self.assertEqual(create_related_users.call_args_list[0][1], {'source': 'graphql'})
+
+
+class FetchAllTest(TestCase):
+
+    class Fetcher(object):
+        def __init__(self, pages):
+            self.pages = pages
+            self.calls = 0
+
+        @fetch_all
+        def fetch_pages(self, next_url=None):
+            self.calls += 1
+            page = int(next_url or 0)
+            next_url = str(page + 1) if page + 1 < len(self.pages) else None
+            return self.pages[page], {'pagination': {'next_url': next_url}}
+
+    def test_many_pages(self):
+        fetcher = self.Fetcher([[i] for i in range(3000)])
+
+        self.assertEqual(fetcher.fetch_pages(), [0])
+        self.assertEqual(fetcher.fetch_pages(all=True), range(3000))
+
+    def test_stream(self):
+        fetcher = self.Fetcher([[1, 2], [3], [4]])
+
+        pages = fetcher.fetch_pages(stream=True)
+        self.assertEqual(fetcher.calls, 0)
+        self.assertEqual(next(pages), [1, 2])
+        self.assertEqual(fetcher.calls, 1)
+        self.assertEqual(list(pages), [[3], [4]])
+
+    def test_querysets(self):
+        users = [UserFactory() for i in range(3)]
+        fetcher = self.Fetcher([User.objects.filter(pk=user.pk) for user in users] + [User.objects.none()])
+
+        instances = fetcher.fetch_pages(all=True)
+        self.assertEqual(sorted(instances.values_list('pk', flat=True)), sorted([user.pk for user in users]))
+
+    def test_many_querysets(self):
+        User.objects.bulk_create([User(id=id, username='user%d' % id) for id in range(1, 3001)])
+        fetcher = self.Fetcher([User.objects.filter(pk__in=range(id, id + 500)) for id in range(1, 3001, 500)])
+
+        # keys are passed by one parameter, their number isn't limited by parameters limit of database
+        instances = fetcher.fetch_pages(all=True)
+        self.assertEqual(len(instances.query.sql_with_params()[1]), 1)
+        self.assertEqual(instances.count(), 3000)
+        self.assertEqual(instances.filter(username='user3000').count(), 1)
+
 # class InstagramApiTest(UserTest, MediaTest):
 #     def call(api, *a, **kw):
 #         raise InstagramAPIError(503, "Rate limited", "Your client is making too many request per second")
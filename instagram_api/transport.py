@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+import base64
+import gzip
+import re
+import threading
+import urllib
+import urlparse
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from cookielib import DefaultCookiePolicy
+
+import requests
+import simplejson as json
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+__all__ = ['Response', 'PooledTransport', 'CassetteTransport', 'CassetteError', 'cassette', 'get_transport',
+           'get_pooled_transport', 'strip_secret_parameters', 'add_url_parameters']
+
+# number of hosts and connections per host kept alive in the pool
+POOL_CONNECTIONS = getattr(settings, 'SOCIAL_API_INSTAGRAM_POOL_CONNECTIONS', 10)
+POOL_MAXSIZE = getattr(settings, 'SOCIAL_API_INSTAGRAM_POOL_MAXSIZE', 10)
+# connect and read timeouts in seconds
+TIMEOUT = getattr(settings, 'SOCIAL_API_INSTAGRAM_TIMEOUT', (10, 60))
+# size of chunks of streamed responses in bytes
+CHUNK_SIZE = getattr(settings, 'SOCIAL_API_INSTAGRAM_CHUNK_SIZE', 16384)
+
+
+class Response(dict):
+    """
+    Response headers in format of httplib2, expected by python-instagram
+    """
+    def __init__(self, status, headers):
+        super(Response, self).__init__([(key.lower(), value) for key, value in headers.items()])
+        self.status = int(status)
+        self['status'] = str(status)
+
+
+class PooledTransport(object):
+    """
+    Keep-alive HTTP transport with pool of connections, thread-safe
+    """
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.session = requests.Session()
+        # session is shared by all tokens and threads, cookies of one request shouldn't be sent with others
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, url, method='GET', body=None, headers=None):
+        response = self.session.request(method, url, data=body, headers=headers, timeout=self.timeout)
+        return Response(response.status_code, response.headers), response.content
+
+    def stream(self, url, method='GET', body=None, headers=None, chunk_size=CHUNK_SIZE):
+        """
+        Return response headers and iterator of chunks of content, read from the connection on demand
+        """
+        response = self.session.request(method, url, data=body, headers=headers, timeout=self.timeout, stream=True)
+
+        def chunks():
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    yield chunk
+            finally:
+                # return connection to the pool even if content is not read completely
+                response.close()
+
+        return Response(response.status_code, response.headers), chunks()
+
+    def close(self):
+        self.session.close()
+
+
+class CassetteError(Exception):
+    pass
+
+
+# parameters of urls with credentials of application and user
+SECRET_PARAMETERS = ('access_token', 'client_id', 'client_secret', 'sig')
+# urls in content of responses, slashes may be escaped in JSON
+URL_RE = re.compile(r'https?:\\?/\\?/[^\s"\'<>]+')
+
+
+def strip_secret_parameters(url):
+    """
+    Remove credentials from url, for example from url of the next page before it's saved
+    """
+    # other parameters and escaped slashes of urls from JSON are kept as is
+    base, separator, query = url.partition('?')
+    query, hash, fragment = query.partition('#')
+    params = query.split('&')
+    secrets = [param for param in params if param.split('=', 1)[0] in SECRET_PARAMETERS]
+    if not secrets:
+        return url
+    query = '&'.join([param for param in params if param not in secrets])
+    return base + (separator if query else '') + query + hash + fragment
+
+
+def add_url_parameters(url, **params):
+    """
+    Add parameters to query of url
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    query = urlparse.parse_qsl(query, keep_blank_values=True) + sorted(params.items())
+    return urlparse.urlunsplit((scheme, netloc, path, urllib.urlencode(query), fragment))
+
+
+class CassetteTransport(object):
+    """
+    Transport recording request/response pairs to gzipped JSON cassette or replaying them from it.
+    Credentials are removed from recorded requests and responses, repeated requests are replayed in order of recording.
+    """
+    secret_parameters = SECRET_PARAMETERS
+    secret_headers = ('status', 'set-cookie')
+
+    def __init__(self, path, mode='replay', transport=None):
+        if mode not in ('record', 'replay'):
+            raise ValueError("Argument mode should be 'record' or 'replay', not '%s'" % mode)
+
+        self.path = path
+        self.mode = mode
+        self.transport = transport
+        self.interactions = []
+        self.queues = defaultdict(deque)
+        self.lock = threading.Lock()
+
+        if self.mode == 'replay':
+            self.load()
+
+    def get_key(self, url, method, body):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        query = sorted([(k, v) for k, v in urlparse.parse_qsl(query) if k not in self.secret_parameters])
+        if isinstance(body, dict):
+            body = urllib.urlencode(sorted(body.items()))
+        return '%s %s://%s%s?%s %s' % (method, scheme, netloc, path, urllib.urlencode(query), body or '')
+
+    def request(self, url, method='GET', body=None, headers=None):
+        key = self.get_key(url, method, body)
+
+        if self.mode == 'replay':
+            with self.lock:
+                queue = self.queues.get(key)
+                if not queue:
+                    raise CassetteError("Request '%s' is not found in cassette %s" % (key, self.path))
+                # last response of the request is repeated for all later calls
+                interaction = queue.popleft() if len(queue) > 1 else queue[0]
+            return self.decode_response(interaction)
+
+        response, content = (self.transport or get_pooled_transport()).request(url, method, body, headers)
+        with self.lock:
+            self.interactions += [self.encode_response(key, response, content)]
+        return response, content
+
+    def stream(self, url, method='GET', body=None, headers=None, chunk_size=CHUNK_SIZE):
+        response, content = self.request(url, method, body, headers)
+        return response, (content[i:i + chunk_size] for i in range(0, len(content), chunk_size))
+
+    def encode_response(self, key, response, content):
+        try:
+            # urls of the next pages in content contain access token
+            content, encoding = URL_RE.sub(self.strip_url, content.decode('utf-8')), 'utf-8'
+        except UnicodeDecodeError:
+            content, encoding = base64.b64encode(content), 'base64'
+        headers = dict([(k, v) for k, v in response.items() if k not in self.secret_headers])
+        return {'request': key, 'status': response.status, 'headers': headers,
+                'content': content, 'encoding': encoding}
+
+    def strip_url(self, match):
+        return strip_secret_parameters(match.group(0))
+
+    def decode_response(self, interaction):
+        content = interaction['content']
+        if interaction['encoding'] == 'base64':
+            content = base64.b64decode(content)
+        else:
+            content = content.encode('utf-8')
+        return Response(interaction['status'], interaction['headers']), content
+
+    def load(self):
+        with gzip.open(self.path, 'rb') as f:
+            self.interactions = json.loads(f.read())['interactions']
+        for interaction in self.interactions:
+            self.queues[interaction['request']].append(interaction)
+
+    def save(self):
+        with gzip.open(self.path, 'wb') as f:
+            f.write(json.dumps({'interactions': self.interactions}))
+
+    def close(self):
+        if self.mode == 'record':
+            self.save()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+_cassette = None
+
+
+@contextmanager
+def cassette(path, mode='replay'):
+    """
+    Record or replay all HTTP requests of REST and GraphQL clients inside of context
+
+        with cassette('user_followers.json.gz', mode='record'):
+            user.fetch_followers()
+    """
+    global _cassette
+    _cassette = CassetteTransport(path, mode)
+    try:
+        yield _cassette
+    finally:
+        _cassette.close()
+        _cassette = None
+
+
+def get_transport():
+    """
+    Return active cassette if any or pooled transport
+    """
+    return _cassette or get_pooled_transport()
+
+
+def get_pooled_transport():
+    """
+    Return pooled transport shared by all threads of the process
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = PooledTransport()
+    return _transport